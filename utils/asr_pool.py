@@ -0,0 +1,201 @@
+import gc
+import threading
+import time
+from contextlib import contextmanager
+
+import torch
+from faster_whisper import WhisperModel
+
+
+def default_device():
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def default_compute_type(device):
+    # float16 is only efficient on GPU
+    return "float16" if device == "cuda" else "float32"
+
+
+def free_memory_bytes(device):
+    """Free memory on the GPU, or available system memory for the CPU, None if unknown"""
+    if device == "cuda" and torch.cuda.is_available():
+        free, _ = torch.cuda.mem_get_info()
+        return free
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class _PooledModel:
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+        self.users = 0
+        self.last_used = time.monotonic()
+
+
+class ASRModelPool:
+    """Process wide cache of WhisperModel instances keyed by (model name, device, compute type, options).
+
+    Loading a large Whisper model takes tens of seconds, so models stay loaded after use. A model nobody
+    uses is unloaded after `idle_timeout` seconds, or earlier when free memory on its device drops below
+    `min_free_memory` bytes or another model needs the room (at most `max_models` are kept).
+    """
+
+    def __init__(self, idle_timeout=600, min_free_memory=2 * 1024**3, max_models=2, check_interval=30):
+        self.idle_timeout = idle_timeout
+        self.min_free_memory = min_free_memory
+        self.max_models = max_models
+        self.check_interval = check_interval
+        self._models = {}
+        self._lock = threading.RLock()
+        self._reaper = None
+
+    def acquire(self, model_name, device=None, compute_type=None, **model_kwargs):
+        """A loaded WhisperModel, `model_kwargs` (device_index, cpu_threads...) are passed to WhisperModel"""
+        device = device or default_device()
+        compute_type = compute_type or default_compute_type(device)
+        key = (model_name, device, compute_type) + tuple(sorted(model_kwargs.items()))
+        with self._lock:
+            pooled = self._models.get(key)
+            if pooled is None:
+                self._make_room(device, reserve=1)
+                print(f"Loading Whisper Model {model_name} ({device}, {compute_type})!")
+                model = WhisperModel(model_name, device=device, compute_type=compute_type, **model_kwargs)
+                pooled = _PooledModel(model, device)
+                self._models[key] = pooled
+            pooled.users += 1
+            pooled.last_used = time.monotonic()
+            self._start_reaper()
+            return pooled.model
+
+    def release(self, model):
+        with self._lock:
+            for pooled in self._models.values():
+                if pooled.model is model:
+                    pooled.users -= 1
+                    pooled.last_used = time.monotonic()
+                    return
+
+    @contextmanager
+    def model(self, model_name, device=None, compute_type=None, **model_kwargs):
+        model = self.acquire(model_name, device, compute_type, **model_kwargs)
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def evict_idle(self, older_than=0):
+        """Unload every model nobody uses that has been idle for at least `older_than` seconds"""
+        now = time.monotonic()
+        with self._lock:
+            keys = [
+                key
+                for key, pooled in self._models.items()
+                if pooled.users == 0 and now - pooled.last_used >= older_than
+            ]
+            self._evict(keys)
+        return keys
+
+    def _make_room(self, device, reserve=0):
+        # unload idle models, least recently used first, until `reserve` more fit and memory is not short
+        idle = sorted(
+            (key for key, pooled in self._models.items() if pooled.users == 0),
+            key=lambda key: self._models[key].last_used,
+        )
+        while idle and (len(self._models) + reserve > self.max_models or self._low_on_memory(device)):
+            self._evict([idle.pop(0)])
+
+    def _low_on_memory(self, device):
+        free = free_memory_bytes(device)
+        return free is not None and free < self.min_free_memory
+
+    def _evict(self, keys):
+        if not keys:
+            return
+        for key in keys:
+            print(f"Unloading Whisper Model {key[0]} ({key[1]}, {key[2]})")
+            del self._models[key]
+        # deallocate VRAM and RAM
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _start_reaper(self):
+        if self._reaper is None or not self._reaper.is_alive():
+            self._reaper = threading.Thread(target=self._reap, name="asr-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(min(self.check_interval, self.idle_timeout))
+            with self._lock:
+                if not self._models:
+                    self._reaper = None
+                    return
+                self.evict_idle(self.idle_timeout)
+                for device in {pooled.device for pooled in self._models.values()}:
+                    if self._low_on_memory(device):
+                        self._make_room(device)
+
+
+asr_pool = ASRModelPool()
+
+
+class _StubWhisper:
+    # stands in for a WhisperModel in the tests
+    loads = []
+
+    def __init__(self, model_name, **kwargs):
+        self.model_name = model_name
+        _StubWhisper.loads.append(model_name)
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_eviction():
+    global WhisperModel
+    whisper_model, WhisperModel = WhisperModel, _StubWhisper
+    _StubWhisper.loads = []
+    try:
+        pool = ASRModelPool(idle_timeout=0.2, min_free_memory=0, max_models=2, check_interval=0.02)
+        model_a = pool.acquire("a", device="cpu")
+        assert pool.acquire("a", device="cpu") is model_a and _StubWhisper.loads == ["a"]
+        pool.release(model_a)
+        with pool.model("b", device="cpu"):
+            pass
+        # b is idle and goes to make room for c, a is in use and stays past max_models
+        model_c = pool.acquire("c", device="cpu")
+        model_d = pool.acquire("d", device="cpu")
+        assert sorted(key[0] for key in pool._models) == ["a", "c", "d"]
+        pool.release(model_c)
+        pool.release(model_d)
+        # the idle models are unloaded after idle_timeout, the one in use never is
+        assert _wait_for(lambda: sorted(key[0] for key in pool._models) == ["a"])
+        time.sleep(0.3)
+        assert sorted(key[0] for key in pool._models) == ["a"]
+        pool.release(model_a)
+        assert _wait_for(lambda: not pool._models and pool._reaper is None)
+        assert _StubWhisper.loads == ["a", "b", "c", "d"]
+
+        # short on memory, idle models are unloaded before another one loads, models in use are kept
+        pool = ASRModelPool(idle_timeout=60, min_free_memory=float("inf"), max_models=2)
+        with pool.model("a", device="cpu"):
+            pass
+        with pool.model("b", device="cpu"):
+            assert sorted(key[0] for key in pool._models) == ["b"]
+            with pool.model("c", device="cpu"):
+                assert sorted(key[0] for key in pool._models) == ["b", "c"]
+        assert pool.evict_idle() and not pool._models
+    finally:
+        WhisperModel = whisper_model
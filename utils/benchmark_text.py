@@ -0,0 +1,301 @@
+"""Benchmarks for the text frontend in utils/tokenizer.py.
+
+Run from the repository root, e.g. `python -m utils.benchmark_text split`. The `suite` benchmark writes
+JSON that can be compared across commits with `python -m utils.benchmark_text compare old.json new.json`.
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from utils import tokenizer
+
+HINDI_SAMPLE = "यह एक लंबा वाक्य है जो हिंदी में लिखा गया है। क्या आप इसे पढ़ सकते हैं? हाँ, बिल्कुल! "
+ENGLISH_SAMPLE = "This is a fairly long sentence written in English. Can you read it? Yes, of course! "
+CHINESE_SAMPLE = "在12.5秒内有50名士兵。"
+KOREAN_SAMPLE = "배터리 잔량이 십사 퍼센트입니다."
+
+
+def long_text(sample, length=5000):
+    return (sample * (length // len(sample) + 1))[:length].rsplit(" ", 1)[0]
+
+
+def _time_calls(fn, repeat):
+    fn()  # warm up, so first-use costs are not counted
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return repeat / (time.perf_counter() - start)
+
+
+def bench_split(length=5000, repeat=50, text_split_length=250):
+    """Report split_sentence calls per second for each sentence splitting path"""
+    results = []
+    for lang, sample in (("hi", HINDI_SAMPLE), ("en", ENGLISH_SAMPLE)):
+        text = long_text(sample, length)
+        pool = tokenizer._sentencizer_pool
+        try:
+            # a pool that keeps nothing idle rebuilds the spaCy pipeline on every call, like before pooling
+            tokenizer._sentencizer_pool = tokenizer.SentencizerPool(max_idle_per_language=0)
+            unpooled = _time_calls(lambda: tokenizer.split_sentence(text, lang, text_split_length), repeat)
+        finally:
+            tokenizer._sentencizer_pool = pool
+        pooled = _time_calls(lambda: tokenizer.split_sentence(text, lang, text_split_length), repeat)
+        regex = _time_calls(
+            lambda: tokenizer.split_sentence(text, lang, text_split_length, splitter="regex"), repeat
+        )
+        results.append((lang, unpooled, pooled, regex))
+
+    print(f"split_sentence on {length} character inputs (splits/sec)")
+    print(f"{'lang':<6}{'spacy (unpooled)':>18}{'spacy (pooled)':>16}{'regex':>12}")
+    for lang, unpooled, pooled, regex in results:
+        print(f"{lang:<6}{unpooled:>18.1f}{pooled:>16.1f}{regex:>12.1f}")
+    return results
+
+
+def bench_normalizers(repeat=2000):
+    """Report per-call latency of the zh number normalizer and ko transliterator, rebuilt per call vs reused"""
+    cases = [
+        (
+            "zh expand_numbers",
+            lambda: tokenizer._lazy_import("zh_num2words")()(CHINESE_SAMPLE),
+            lambda: tokenizer.expand_numbers_multilingual(CHINESE_SAMPLE, "zh"),
+        ),
+        (
+            "ko transliterate",
+            lambda: tokenizer._lazy_import("Transliter")(tokenizer._lazy_import("academic")).translit(KOREAN_SAMPLE),
+            lambda: tokenizer.korean_transliterate(KOREAN_SAMPLE),
+        ),
+    ]
+    print("per-call latency (microseconds)")
+    print(f"{'':<20}{'rebuilt per call':>18}{'reused':>12}")
+    results = []
+    for name, rebuilt, reused in cases:
+        before = 1e6 / _time_calls(rebuilt, repeat)
+        after = 1e6 / _time_calls(reused, repeat)
+        results.append((name, before, after))
+        print(f"{name:<20}{before:>18.1f}{after:>12.1f}")
+    return results
+
+
+def bench_chunks(vocab_file, length=5000, max_tokens=tokenizer.DEFAULT_TEXT_TOKEN_BUDGET):
+    """Compare chunk counts and token sizes of character based and token budget based splitting"""
+    bpe = tokenizer.VoiceBpeTokenizer(vocab_file)
+    print(f"{'lang':<6}{'splitter':<22}{'chunks':>8}{'max tokens':>12}{'mean tokens':>13}")
+    results = []
+    for lang, sample in (("hi", HINDI_SAMPLE), ("en", ENGLISH_SAMPLE)):
+        text = long_text(sample, length)
+        by_chars = tokenizer.split_sentence(text, lang, bpe.char_limits[lang])
+        by_chars = [(chunk, bpe.count_tokens(chunk, lang)) for chunk in by_chars]
+        by_tokens = tokenizer.split_sentence_by_tokens(text, lang, bpe, max_tokens=max_tokens)
+        for name, chunks in ((f"chars ({bpe.char_limits[lang]})", by_chars), (f"tokens ({max_tokens})", by_tokens)):
+            counts = [n_tokens for _, n_tokens in chunks]
+            results.append((lang, name, len(chunks), max(counts), sum(counts) / len(counts)))
+            print(f"{lang:<6}{name:<22}{len(chunks):>8}{max(counts):>12}{sum(counts) / len(counts):>13.1f}")
+    return results
+
+
+ALL_LANGUAGES = ["en", "es", "fr", "de", "it", "pt", "pl", "tr", "ru", "nl", "cs", "ar", "zh", "hu", "ko", "ja", "hi"]
+
+_IMPORT_PROBE = """
+import resource, sys, time
+start = time.perf_counter()
+from utils import tokenizer
+tokenizer.preload_languages(sys.argv[1].split(",") if sys.argv[1] else [])
+print(time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def bench_import(preload_sets=None):
+    """Report cold-start import seconds and peak RSS of utils.tokenizer for different preloaded languages"""
+    if preload_sets is None:
+        preload_sets = [("all languages (eager)", ALL_LANGUAGES), ("hi", ["hi"]), ("none (lazy)", [])]
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    print(f"{'preloaded':<24}{'import seconds':>16}{'max RSS (MB)':>14}")
+    results = []
+    for name, languages in preload_sets:
+        # a fresh interpreter per measurement, so nothing is already imported
+        out = subprocess.run(
+            [sys.executable, "-c", _IMPORT_PROBE, ",".join(languages)],
+            cwd=repo_root,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.split()
+        seconds, rss_mb = float(out[-2]), int(out[-1]) / 1024  # ru_maxrss is in KB on Linux
+        results.append((name, seconds, rss_mb))
+        print(f"{name:<24}{seconds:>16.2f}{rss_mb:>14.1f}")
+    return results
+
+
+def suite_inputs(long_length=2000):
+    """Per language inputs: the short test table inputs and one long text generated from them"""
+    inputs = {}
+    for text, _, lang in tokenizer.EXPAND_NUMBERS_TEST_CASES + tokenizer.ABBREVIATIONS_TEST_CASES + tokenizer.SYMBOLS_TEST_CASES:
+        inputs.setdefault(lang, {"short": []})["short"].append(text)
+    inputs["hi"]["short"].append(HINDI_SAMPLE.strip())
+    inputs["en"]["short"].append(ENGLISH_SAMPLE.strip())
+    for lang in inputs:
+        inputs[lang]["long"] = [long_text(" ".join(inputs[lang]["short"]) + " ", long_length)]
+    return inputs
+
+
+def _percentile(sorted_values, q):
+    return sorted_values[min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))]
+
+
+def _measure(fn, texts, min_calls):
+    # inputs `fn` fails on (a language num2words cannot spell numbers in...) are left out of the timings and
+    # listed under "errors"
+    errors = []
+    working = []
+    for text in texts:
+        try:
+            fn(text)  # warm up caches, pools and lazy imports
+        except Exception as e:
+            errors.append({"text": text, "error": f"{type(e).__name__}: {e}"})
+        else:
+            working.append(text)
+    if not working:
+        return {"calls": 0, "errors": errors}
+    texts = working
+    latencies = []
+    n_chars = 0
+    rounds = max(1, -(-min_calls // len(texts)))
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            call_start = time.perf_counter()
+            fn(text)
+            latencies.append(time.perf_counter() - call_start)
+            n_chars += len(text)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    stats = {
+        "calls": len(latencies),
+        "calls_per_sec": len(latencies) / elapsed,
+        "chars_per_sec": n_chars / elapsed,
+        "p50_us": _percentile(latencies, 50) * 1e6,
+        "p99_us": _percentile(latencies, 99) * 1e6,
+    }
+    if errors:
+        stats["errors"] = errors
+    return stats
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__)
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_suite(vocab_file=None, languages=None, min_calls=200, long_length=2000):
+    """Throughput and p50/p99 latency of the text frontend per function, language and input size.
+
+    encode and decode are only measured when `vocab_file` exists. Inputs a function fails on are reported
+    in the "errors" of its result instead of being timed.
+    """
+    inputs = suite_inputs(long_length)
+    languages = languages or sorted(inputs)
+    unknown = sorted(set(languages) - set(inputs))
+    if unknown:
+        raise ValueError(f"No suite inputs for {', '.join(unknown)}, the languages are {', '.join(sorted(inputs))}")
+    bpe = tokenizer.VoiceBpeTokenizer(vocab_file) if vocab_file and os.path.isfile(vocab_file) else None
+
+    results = {}
+    for lang in languages:
+        functions = {
+            "multilingual_cleaners": lambda text: tokenizer.multilingual_cleaners(text, lang),
+            "split_sentence": lambda text: tokenizer.split_sentence(text, lang),
+        }
+        if bpe is not None:
+            functions["encode"] = lambda text: bpe.encode(text, lang)
+        for size, texts in inputs[lang].items():
+            for name, fn in functions.items():
+                results.setdefault(name, {}).setdefault(lang, {})[size] = _measure(fn, texts, min_calls)
+            if bpe is not None:
+                encoded = {}
+                for text in texts:
+                    # the texts encode fails on are in its errors
+                    with contextlib.suppress(Exception):
+                        encoded[text] = bpe.encode(text, lang)
+                if encoded:
+                    results.setdefault("decode", {}).setdefault(lang, {})[size] = _measure(
+                        lambda text: bpe.decode(encoded[text]), list(encoded), min_calls
+                    )
+
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "min_calls": min_calls,
+            "long_length": long_length,
+        },
+        "results": results,
+    }
+
+
+def compare_suites(old, new, metric="p50_us"):
+    """Print the relative change of `metric` between two suite results"""
+    print(f"{metric}: {old['meta']['commit']} -> {new['meta']['commit']}")
+    print(f"{'function':<24}{'lang':<4}{'size':<7}{'old':>12}{'new':>12}{'change':>10}")
+    for name, langs in new["results"].items():
+        for lang, sizes in langs.items():
+            for size, stats in sizes.items():
+                before = old["results"].get(name, {}).get(lang, {}).get(size)
+                # inputs that failed on every call have no timings
+                if before is None or metric not in before or metric not in stats:
+                    continue
+                change = (stats[metric] - before[metric]) / before[metric] * 100
+                print(f"{name:<24}{lang:<4}{size:<7}{before[metric]:>12.1f}{stats[metric]:>12.1f}{change:>+9.1f}%")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Text frontend microbenchmarks")
+    parser.add_argument(
+        "benchmark", choices=["split", "normalizers", "import", "chunks", "suite", "compare"], help="Which benchmark to run"
+    )
+    parser.add_argument("files", nargs="*", help="For 'compare': the old and the new suite JSON")
+    parser.add_argument("--length", type=int, default=5000, help="Characters per input text. Default: 5000")
+    parser.add_argument("--repeat", type=int, default=50, help="Timed calls per measurement. Default: 50")
+    parser.add_argument(
+        "--vocab", type=str, default=tokenizer.DEFAULT_VOCAB_FILE, help="XTTS vocab.json for 'chunks' and 'suite'"
+    )
+    parser.add_argument(
+        "--langs", nargs="*", default=[], choices=sorted(suite_inputs()), help="Languages for 'suite'. Default: all"
+    )
+    parser.add_argument("--output", type=str, default="", help="Where 'suite' writes its JSON. Default: stdout")
+    args = parser.parse_args()
+
+    if args.benchmark == "split":
+        bench_split(length=args.length, repeat=args.repeat)
+    elif args.benchmark == "normalizers":
+        bench_normalizers(repeat=args.repeat * 40)
+    elif args.benchmark == "import":
+        bench_import()
+    elif args.benchmark == "chunks":
+        bench_chunks(args.vocab, length=args.length)
+    elif args.benchmark == "suite":
+        # encode warns about long inputs on stdout, keep that out of the JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            report = bench_suite(args.vocab, languages=args.langs, min_calls=args.repeat * 4)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+        else:
+            print(json.dumps(report, indent=2, ensure_ascii=False))
+    elif args.benchmark == "compare":
+        if len(args.files) != 2:
+            parser.error("compare needs the old and the new suite JSON")
+        with open(args.files[0], encoding="utf-8") as old, open(args.files[1], encoding="utf-8") as new:
+            compare_suites(json.load(old), json.load(new))
@@ -0,0 +1,326 @@
+"""Build a dataset with several processes, each transcribing its own shard of the audio files.
+
+All shards on this machine, then the merge:
+
+    python -m utils.build_dataset build AUDIO_DIR dataset --language hi --workers 4
+
+Or one shard at a time, for example one per GPU or machine sharing the dataset folder, then the merge:
+
+    python -m utils.build_dataset shard AUDIO_DIR dataset --language hi --shard 0 --num_shards 4
+    python -m utils.build_dataset merge dataset --num_shards 4
+
+Each shard records its clips in its own manifest, the merge folds them into the dataset manifest and writes
+metadata_train.csv / metadata_eval.csv with a seeded split, so the result only depends on the files, the
+settings and the seed, not on the number of shards or their timing.
+"""
+import argparse
+import heapq
+import multiprocessing
+import os
+import tempfile
+import time
+
+import torch
+
+from utils.clip_quality import ClipQuality
+from utils.formatter import MANIFEST_NAME, build_clips, list_audios, load_manifest, save_manifest, write_metadata
+from utils.transcript_cache import transcript_cache
+
+
+def shard_files(audio_files, shard, num_shards):
+    """The files of shard `shard` of `num_shards`, sorted by path.
+
+    Files are dealt largest first to the shard with the fewest bytes so far (the lowest index on ties), so
+    shards get about the same amount of audio and the assignment only depends on the file list.
+    """
+    files = sorted(set(audio_files), key=lambda path: (-os.path.getsize(path), path))
+    loads = [(0, k) for k in range(num_shards)]
+    assigned = []
+    for path in files:
+        load, k = heapq.heappop(loads)
+        if k == shard:
+            assigned.append(path)
+        heapq.heappush(loads, (load + os.path.getsize(path), k))
+    return sorted(assigned)
+
+
+def shard_manifest_name(shard, num_shards):
+    return f"manifest.shard-{shard:03d}-of-{num_shards:03d}.json"
+
+
+def _prepare_shard(out_path, shard, num_shards):
+    # a shard manifest starts as a copy of the dataset manifest, so the shard skips the files already built,
+    # one left by an interrupted run is kept and the shard resumes from it
+    shard_path = os.path.join(out_path, shard_manifest_name(shard, num_shards))
+    if not os.path.isfile(shard_path):
+        os.makedirs(out_path, exist_ok=True)
+        save_manifest(load_manifest(os.path.join(out_path, MANIFEST_NAME)), shard_path)
+
+
+def shard_asr_options(shard, num_shards):
+    """Whisper options of a shard: one GPU per shard, round robin, or an equal share of the CPU cores"""
+    if torch.cuda.is_available():
+        return {"device": "cuda", "device_index": shard % torch.cuda.device_count()}
+    return {"device": "cpu", "cpu_threads": max(os.cpu_count() // num_shards, 1)}
+
+
+def run_shard(audio_files, out_path, shard, num_shards, use_transcript_cache=True, **options):
+    """Build the clips of shard `shard` with its own Whisper instance, `options` go to build_clips"""
+    asr_options = shard_asr_options(shard, num_shards)
+    if asr_options["device"] == "cpu":
+        torch.set_num_threads(asr_options["cpu_threads"])
+    files = shard_files(audio_files, shard, num_shards)
+    print(f"Shard {shard} of {num_shards}: {len(files)} files")
+    _prepare_shard(out_path, shard, num_shards)
+
+    manifest_name = shard_manifest_name(shard, num_shards)
+    manifest = build_clips(
+        files,
+        out_path,
+        manifest_name=manifest_name,
+        transcript_cache=transcript_cache if use_transcript_cache else None,
+        asr_options=asr_options,
+        **options,
+    )
+    # the merge refuses shards that did not finish
+    manifest["complete"] = True
+    save_manifest(manifest, os.path.join(out_path, manifest_name))
+    return len(files)
+
+
+def merge_shards(
+    out_path,
+    num_shards,
+    eval_percentage=0.15,
+    seed=0,
+    packed=False,
+    sample_rate=None,
+    language=None,
+    speaker_name="coqui",
+    vocab_file=None,
+    quality=None,
+):
+    """Fold the shard manifests into the dataset manifest and write the metadata, see write_metadata"""
+    manifest_path = os.path.join(out_path, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    entries = manifest["files"]
+    base = set(entries)
+
+    removed, added, shard_paths = set(), {}, []
+    for shard in range(num_shards):
+        shard_path = os.path.join(out_path, shard_manifest_name(shard, num_shards))
+        shard_manifest = load_manifest(shard_path)
+        if not shard_manifest.get("complete"):
+            raise RuntimeError(f"Shard {shard} of {num_shards} did not finish, run it again before merging")
+        # every shard started from the dataset manifest: what it lost it replaced, what it gained it built
+        removed |= base - set(shard_manifest["files"])
+        added.update((key, entry) for key, entry in shard_manifest["files"].items() if key not in base)
+        shard_paths.append(shard_path)
+
+    for key in removed:
+        del entries[key]
+    for key in sorted(added):
+        entries[key] = added[key]
+    save_manifest(manifest, manifest_path)
+    for shard_path in shard_paths:
+        os.remove(shard_path)
+    print(f"Merged {num_shards} shards: {len(added)} sources added, {len(removed)} replaced or removed")
+    return write_metadata(
+        out_path,
+        manifest,
+        eval_percentage,
+        seed=seed,
+        packed=packed,
+        sample_rate=sample_rate,
+        language=language,
+        speaker_name=speaker_name,
+        vocab_file=vocab_file,
+        quality=quality,
+    )
+
+
+def build_dataset(
+    audio_files,
+    out_path,
+    num_workers=None,
+    eval_percentage=0.15,
+    seed=0,
+    packed=False,
+    use_transcript_cache=True,
+    speaker_name="coqui",
+    vocab_file=None,
+    quality=None,
+    **options,
+):
+    """Build the clips of `audio_files` in `num_workers` processes, one shard each, then merge them.
+
+    Defaults to a worker per GPU, or one per 4 cores without a GPU. `options` go to build_clips. Returns the
+    metadata paths and the total duration of the dataset in seconds, like format_audio_list.
+    """
+    num_workers = num_workers or torch.cuda.device_count() or max(os.cpu_count() // 4, 1)
+
+    start = time.perf_counter()
+    jobs = [(audio_files, out_path, shard, num_workers, use_transcript_cache) for shard in range(num_workers)]
+    # spawn, CUDA and CTranslate2 do not survive a fork
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(num_workers, maxtasksperchild=1) as pool:
+        results = [pool.apply_async(run_shard, job, options) for job in jobs]
+        for result in results:
+            result.get()
+    print(f"Built {num_workers} shards in {time.perf_counter() - start:.1f}s")
+    return merge_shards(
+        out_path,
+        num_workers,
+        eval_percentage,
+        seed,
+        packed=packed,
+        sample_rate=options.get("sample_rate"),
+        language=options.get("target_language"),
+        speaker_name=speaker_name,
+        vocab_file=vocab_file,
+        quality=quality,
+    )
+
+
+def _build_in_process(audio_files, out_path, num_shards, **options):
+    # the shards of build_dataset, one after the other in this process
+    num_threads = torch.get_num_threads()
+    try:
+        for shard in range(num_shards):
+            run_shard(audio_files, out_path, shard, num_shards, use_transcript_cache=False, **options)
+    finally:
+        torch.set_num_threads(num_threads)
+    metadata = []
+    for metadata_path in merge_shards(out_path, num_shards, eval_percentage=0.25)[:2]:
+        with open(metadata_path, "r", encoding="utf-8") as f:
+            metadata.append(f.read())
+    return metadata
+
+
+def test_shard_count_independence():
+    from utils.formatter import _ScriptedASR, _write_tone
+    from utils.transcript_cache import Word
+
+    words = [Word(0.2, 0.6, " One", 0.9), Word(0.7, 1.2, " two.", 0.9), Word(2.0, 2.5, " Three.", 0.9)]
+    with tempfile.TemporaryDirectory() as tmp:
+        audio_files = [os.path.join(tmp, "audio", f"{name}.wav") for name in "abcde"]
+        os.makedirs(os.path.join(tmp, "audio"))
+        for k, audio_file in enumerate(audio_files):
+            _write_tone(audio_file, 3 + k % 3, 0.1 + 0.05 * k)
+        options = {"target_language": "en", "audio_root": os.path.join(tmp, "audio"), "io_workers": 1}
+
+        metadata = {}
+        for num_shards in (1, 2, 3):
+            asr = _ScriptedASR(words)
+            out_path = os.path.join(tmp, f"dataset_{num_shards}")
+            metadata[num_shards] = _build_in_process(audio_files, out_path, num_shards, asr_model=asr, **options)
+            assert asr.calls == len(audio_files)
+            assert not [name for name in os.listdir(out_path) if name.startswith("manifest.shard-")]
+        assert metadata[1] == metadata[2] == metadata[3]
+        assert sum(text.count("\n") - 1 for text in metadata[1]) == 2 * len(audio_files), metadata[1]
+
+        # a rerun with one changed source replaces that source's clips, whatever the shard it lands in
+        out_path = os.path.join(tmp, "dataset_1")
+        manifest = load_manifest(os.path.join(out_path, MANIFEST_NAME))
+        _write_tone(audio_files[2], 4, 0.6)
+        asr = _ScriptedASR(words)
+        rebuilt = _build_in_process(audio_files, out_path, 2, asr_model=asr, **options)
+        assert asr.calls == 1
+        entries = load_manifest(os.path.join(out_path, MANIFEST_NAME))["files"]
+        assert sorted(entry["source"] for entry in entries.values()) == list("abcde"), entries
+        assert len(set(entries) - set(manifest["files"])) == 1
+        assert sum(text.count("\n") - 1 for text in rebuilt) == 2 * len(audio_files), rebuilt
+        assert sorted(os.listdir(os.path.join(out_path, "wavs"))) == sorted(
+            row.split("|")[0][len("wavs/") :] for text in rebuilt for row in text.splitlines()[1:]
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a dataset in shards, with one process per shard")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_build_arguments(subparser):
+        subparser.add_argument("audio_dir", type=str, help="Folder searched for audio files")
+        subparser.add_argument("out_path", type=str, help="Dataset folder")
+        subparser.add_argument("--language", type=str, required=True, help="Language of the audio")
+        subparser.add_argument("--whisper_model", type=str, default="large-v2", help="Default: large-v2")
+        subparser.add_argument("--sample_rate", type=int, default=None, help="Clip sample rate. Default: source")
+        subparser.add_argument("--pcm16", action="store_true", help="Write 16 bit clips")
+        subparser.add_argument(
+            "--target_duration", type=float, default=None, help="Pack sentences into clips of about this many seconds"
+        )
+        subparser.add_argument("--max_gap", type=float, default=1.0, help="Longest pause packed clips span. Default: 1")
+        subparser.add_argument("--no_transcript_cache", action="store_true", help="Do not use the transcript cache")
+
+    def add_merge_arguments(subparser):
+        subparser.add_argument("--eval_percentage", type=float, default=0.15, help="Default: 0.15")
+        subparser.add_argument("--seed", type=int, default=0, help="Seed of the train/eval split. Default: 0")
+        subparser.add_argument("--speaker_name", type=str, default="coqui", help="Default: coqui")
+        subparser.add_argument("--packed", action="store_true", help="Also write packed_train and packed_eval")
+        subparser.add_argument("--vocab_file", type=str, default=None, help="XTTS vocab.json, to count text tokens")
+        subparser.add_argument(
+            "--quality_filter", action="store_true", help="Leave the clips ClipQuality drops out of the metadata"
+        )
+
+    build_parser = subparsers.add_parser("build", help="Build every shard in parallel, then merge")
+    add_build_arguments(build_parser)
+    add_merge_arguments(build_parser)
+    build_parser.add_argument("--workers", type=int, default=None, help="Default: one per GPU, or per 4 cores")
+
+    shard_parser = subparsers.add_parser("shard", help="Build one shard")
+    add_build_arguments(shard_parser)
+    shard_parser.add_argument("--shard", type=int, required=True, help="Index of the shard, from 0")
+    shard_parser.add_argument("--num_shards", type=int, required=True)
+
+    merge_parser = subparsers.add_parser("merge", help="Merge finished shards and write the metadata")
+    merge_parser.add_argument("out_path", type=str, help="Dataset folder")
+    merge_parser.add_argument("--num_shards", type=int, required=True)
+    merge_parser.add_argument("--sample_rate", type=int, default=None, help="Sample rate of packed clips")
+    merge_parser.add_argument("--language", type=str, default=None, help="Language of the texts, to count tokens")
+    add_merge_arguments(merge_parser)
+    args = parser.parse_args()
+
+    if args.command in ("build", "shard"):
+        audio_files = sorted(list_audios(args.audio_dir))
+        options = {
+            "target_language": args.language,
+            "whisper_model": args.whisper_model,
+            "sample_rate": args.sample_rate,
+            "pcm16": args.pcm16,
+            "target_duration": args.target_duration,
+            "max_gap": args.max_gap,
+            "audio_root": args.audio_dir,
+        }
+    if args.command == "build":
+        train_path, eval_path, total_seconds = build_dataset(
+            audio_files,
+            args.out_path,
+            args.workers,
+            args.eval_percentage,
+            args.seed,
+            packed=args.packed,
+            use_transcript_cache=not args.no_transcript_cache,
+            speaker_name=args.speaker_name,
+            vocab_file=args.vocab_file,
+            quality=ClipQuality() if args.quality_filter else None,
+            **options,
+        )
+        print(f"{total_seconds / 3600:.1f} hours of audio in {train_path} and {eval_path}")
+    elif args.command == "shard":
+        run_shard(
+            audio_files, args.out_path, args.shard, args.num_shards, not args.no_transcript_cache, **options
+        )
+    else:
+        train_path, eval_path, total_seconds = merge_shards(
+            args.out_path,
+            args.num_shards,
+            args.eval_percentage,
+            args.seed,
+            args.packed,
+            args.sample_rate,
+            args.language,
+            args.speaker_name,
+            args.vocab_file,
+            ClipQuality() if args.quality_filter else None,
+        )
+        print(f"{total_seconds / 3600:.1f} hours of audio in {train_path} and {eval_path}")
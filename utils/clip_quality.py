@@ -0,0 +1,265 @@
+"""Clip quality statistics, to keep clipped, nearly silent, noisy or badly transcribed clips out of training.
+
+The formatter computes the statistics of every clip while slicing and, when given a ClipQuality, filters the
+metadata it writes. Check the metadata of an existing dataset with:
+
+    python -m utils.clip_quality dataset/metadata_train.csv dataset/metadata_eval.csv
+
+which writes a `_quality.csv` report and a `_filtered.csv` metadata next to each csv.
+"""
+import argparse
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas
+import torch
+import torchaudio
+
+# per clip statistics, in the order clip_stats returns them
+STAT_COLUMNS = ["rms_db", "peak", "clipped", "silence", "snr_db"]
+
+FRAME_MS = 30
+# a frame is silent this far below the loudest frame of its clip, or below SILENCE_FLOOR_DB dBFS
+SILENCE_DB = -40
+SILENCE_FLOOR_DB = -60
+# samples this close to full scale count as clipped
+CLIP_LEVEL = 0.999
+# the SNR is the level of the loud frames of a clip over the level of its quiet frames, the noise floor
+SPEECH_QUANTILE = 0.9
+NOISE_QUANTILE = 0.1
+
+
+def frame_clips(clips, frame):
+    """Lay `clips` out back to back in frames of `frame` samples, each zero padded to whole frames and given at
+    least one, so reduceat never sees an empty clip. Returns the (frames, `frame`) float32 array, the number of
+    frames of each clip and the index of its first frame."""
+    lengths = np.array([len(clip) for clip in clips], dtype=np.int64)
+    n_frames = np.maximum(-(-lengths // frame), 1)
+    clip_starts = np.cumsum(n_frames) - n_frames
+    frames = np.zeros((int(n_frames.sum()), frame), dtype=np.float32)
+    flat = frames.reshape(-1)
+    for clip, start in zip(clips, clip_starts):
+        flat[start * frame : start * frame + len(clip)] = clip
+    return frames, n_frames, clip_starts
+
+
+def clip_stats(clips, sample_rate):
+    """Statistics of `clips`, mono float arrays at `sample_rate`, as an (n, 5) array of STAT_COLUMNS.
+
+    The clips are laid out back to back by frame_clips, so every statistic is one NumPy reduction over all
+    the clips: RMS level in dBFS, peak, fraction of clipped samples, fraction of silent frames and the
+    estimated SNR in dB.
+    """
+    frame = max(int(sample_rate * FRAME_MS / 1000), 1)
+    frames, n_frames, clip_starts = frame_clips(clips, frame)
+
+    magnitude = np.abs(frames)
+    frame_power = np.square(frames, dtype=np.float32).sum(axis=1)
+    # empty clips are one silent frame
+    sample_count = np.maximum([len(clip) for clip in clips], 1)
+    rms_db = 10 * np.log10(np.add.reduceat(frame_power, clip_starts) / sample_count + 1e-10)
+    peak = np.maximum.reduceat(magnitude.max(axis=1), clip_starts)
+    clipped = np.add.reduceat((magnitude >= CLIP_LEVEL).sum(axis=1), clip_starts) / sample_count
+
+    energy = 10 * np.log10(frame_power / frame + 1e-10)
+    loudest = np.maximum.reduceat(energy, clip_starts)
+    silent = (energy < np.repeat(loudest, n_frames) + SILENCE_DB) | (energy < SILENCE_FLOOR_DB)
+    silence = np.add.reduceat(silent, clip_starts) / n_frames
+
+    # one sort orders the frames of every clip by energy, each clip's frames staying in its own block
+    ranked = energy[np.lexsort((energy, np.repeat(np.arange(len(clips)), n_frames)))]
+    speech = ranked[clip_starts + ((n_frames - 1) * SPEECH_QUANTILE).astype(np.int64)]
+    noise = ranked[clip_starts + ((n_frames - 1) * NOISE_QUANTILE).astype(np.int64)]
+    return np.stack([rms_db, peak, clipped, silence, speech - noise], axis=1)
+
+
+class ClipQuality:
+    """Thresholds a clip must pass to be trained on.
+
+    A clip is dropped when its RMS level is under `min_rms_db` dBFS, more than `max_clipped` of its samples
+    are clipped, more than `max_silence` of it is silent, its SNR is under `min_snr_db`, or its characters
+    per second are outside `cps_range` times the median of the dataset, which catches transcripts that miss
+    or invent speech whatever the language's speaking rate.
+    """
+
+    def __init__(self, min_rms_db=-35, max_clipped=0.001, max_silence=0.6, cps_range=(0.5, 2.0), min_snr_db=15):
+        self.min_rms_db = min_rms_db
+        self.max_clipped = max_clipped
+        self.max_silence = max_silence
+        self.cps_range = cps_range
+        self.min_snr_db = min_snr_db
+
+    def reasons(self, df):
+        """Why each clip of `df` is dropped, "" for the clips kept. `df` has the STAT_COLUMNS, text and
+        duration."""
+        cps = df["text"].str.replace(" ", "", regex=False).str.len() / df["duration"].clip(lower=1e-3)
+        median_cps = cps.median()
+        checks = {
+            "quiet": df["rms_db"] < self.min_rms_db,
+            "clipped": df["clipped"] > self.max_clipped,
+            "silent": df["silence"] > self.max_silence,
+            "noisy": df["snr_db"] < self.min_snr_db,
+            "slow": cps < self.cps_range[0] * median_cps,
+            "fast": cps > self.cps_range[1] * median_cps,
+        }
+        reasons = pandas.Series("", index=df.index)
+        for name, failed in checks.items():
+            reasons = reasons.where(~failed, reasons + name + ",")
+        return reasons.str.rstrip(",")
+
+    def filter(self, df):
+        """`(kept, report)`: the rows of `df` that pass, and every row with its statistics, characters per
+        second and the reason it was dropped"""
+        report = df.copy()
+        report["cps"] = report["text"].str.replace(" ", "", regex=False).str.len() / report["duration"].clip(
+            lower=1e-3
+        )
+        report["dropped"] = self.reasons(df)
+        kept = df[report["dropped"] == ""].copy()
+        counts = report["dropped"].str.split(",").explode().value_counts().drop("", errors="ignore")
+        summary = ", ".join(f"{count} {name}" for name, count in counts.items())
+        print(f"Quality filter kept {len(kept)} of {len(df)} clips" + (f", dropped {summary}" if summary else ""))
+        return kept, report
+
+
+def _load_clip(path):
+    wav, sr = torchaudio.load(path)
+    return wav.mean(dim=0).numpy(), sr
+
+
+def analyze_clips(paths, analyze, io_workers=8, batch_size=512):
+    """Run `analyze(clips, sample_rate)`, which returns one row per clip, over the clips at `paths` in
+    batches of clips sharing a sample rate, read by `io_workers` threads. Returns the rows in path order and
+    the duration of each clip."""
+    results = [None] * len(paths)
+    durations = np.zeros(len(paths))
+    # clips at another sample rate wait for a batch of their own
+    pending = {}
+
+    def flush(sr):
+        indices, clips = zip(*pending.pop(sr))
+        for i, row in zip(indices, analyze(clips, sr)):
+            results[i] = row
+
+    with ThreadPoolExecutor(max_workers=io_workers) as pool:
+        for i, (clip, sr) in enumerate(pool.map(_load_clip, paths)):
+            durations[i] = len(clip) / sr
+            pending.setdefault(sr, []).append((i, clip))
+            if len(pending[sr]) >= batch_size:
+                flush(sr)
+    for sr in list(pending):
+        flush(sr)
+    return np.array(results), durations
+
+
+def metadata_stats(df, root, io_workers=8):
+    """clip_stats of the clips of a metadata frame, read from `root`, as a frame of STAT_COLUMNS plus
+    duration"""
+    paths = [os.path.join(root, audio_file) for audio_file in df["audio_file"]]
+    stats, durations = analyze_clips(paths, clip_stats, io_workers)
+    result = pandas.DataFrame(stats.reshape(len(paths), len(STAT_COLUMNS)), columns=STAT_COLUMNS, index=df.index)
+    result["duration"] = durations
+    return result
+
+
+def filter_metadata(metadata_path, quality=None, io_workers=8):
+    """Analyze the clips of a metadata csv and write `<name>_quality.csv` and `<name>_filtered.csv` next to it.
+    Returns the filtered metadata path."""
+    quality = quality or ClipQuality()
+    df = pandas.read_csv(metadata_path, sep="|")
+    stats = metadata_stats(df, os.path.dirname(metadata_path), io_workers)
+    # the duration column of the metadata, if any, is replaced by the measured one
+    kept, report = quality.filter(pandas.concat([df.drop(columns="duration", errors="ignore"), stats], axis=1))
+    stem, _ = os.path.splitext(metadata_path)
+    report.to_csv(f"{stem}_quality.csv", sep="|", index=False)
+    filtered_path = f"{stem}_filtered.csv"
+    kept[df.columns].to_csv(filtered_path, sep="|", index=False)
+    return filtered_path
+
+
+def _speech_like(seconds, seed=0, sample_rate=16000):
+    # 250 ms syllables at random pitches and levels, with short pauses in between
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(0.25 * sample_rate)) / sample_rate
+    parts, length = [], 0
+    while length < seconds * sample_rate:
+        syllable = rng.uniform(0.15, 0.3) * np.sin(2 * np.pi * rng.uniform(150, 300) * t) * np.hanning(len(t))
+        parts += [syllable, np.zeros(int(rng.uniform(0.03, 0.12) * sample_rate))]
+        length += len(syllable) + len(parts[-1])
+    return np.concatenate(parts)[: int(seconds * sample_rate)].astype(np.float32)
+
+
+def _bad_clips():
+    rng = np.random.default_rng(0)
+    speech = _speech_like(3)
+    return {
+        "clean": speech + 1e-4 * rng.standard_normal(len(speech)),
+        "noisy": speech + 0.05 * rng.standard_normal(len(speech)),
+        "clipped": np.clip(4 * speech, -1, 1),
+        "silent": np.concatenate([_speech_like(1, seed=1), np.zeros(3 * 16000)]),
+        "quiet": 0.003 * speech,
+    }
+
+
+def test_clip_stats():
+    clips = _bad_clips()
+    stats = clip_stats([clip.astype(np.float32) for clip in clips.values()], 16000)
+    df = pandas.DataFrame(stats, columns=STAT_COLUMNS)
+    df["duration"] = [len(clip) / 16000 for clip in clips.values()]
+    # the same speaking rate for every clip, only the audio fails
+    df["text"] = ["x" * int(10 * duration) for duration in df["duration"]]
+    reasons = ClipQuality().reasons(df).tolist()
+    assert reasons == ["", "noisy", "clipped", "silent", "quiet,silent"], reasons
+
+    # a transcript far from the median rate is dropped too
+    df.loc[0, "text"] = "x" * 200
+    assert ClipQuality().reasons(df)[0] == "fast"
+
+    # thresholds can be loosened one by one
+    loose = ClipQuality(min_rms_db=-100, max_clipped=1, max_silence=1, min_snr_db=-100, cps_range=(0, 100))
+    assert (loose.reasons(df) == "").all()
+
+
+def test_filter_metadata():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "wavs"))
+        clips = _bad_clips()
+        for name, clip in clips.items():
+            torchaudio.save(os.path.join(tmp, "wavs", f"{name}.wav"), torch.from_numpy(clip).unsqueeze(0), 16000)
+        metadata_path = os.path.join(tmp, "metadata_train.csv")
+        df = pandas.DataFrame(
+            {
+                "audio_file": [f"wavs/{name}.wav" for name in clips],
+                "text": ["x" * int(10 * len(clip) / 16000) for clip in clips.values()],
+                "speaker_name": "coqui",
+            }
+        )
+        df.to_csv(metadata_path, sep="|", index=False)
+
+        filtered = pandas.read_csv(filter_metadata(metadata_path, io_workers=2), sep="|")
+        assert filtered.to_dict("records") == df[:1].to_dict("records"), filtered
+        report = pandas.read_csv(os.path.join(tmp, "metadata_train_quality.csv"), sep="|", keep_default_na=False)
+        assert report["dropped"].tolist() == ["", "noisy", "clipped", "silent", "quiet,silent"], report
+        # the metadata itself is left as it was
+        assert pandas.read_csv(metadata_path, sep="|").equals(df)
+
+
+if __name__ == "__main__":
+    defaults = ClipQuality()
+    parser = argparse.ArgumentParser(description="Report and filter low quality clips of metadata csvs")
+    parser.add_argument("metadata", nargs="+", help="Pipe delimited metadata csvs, clip paths relative to them")
+    parser.add_argument("--min_rms_db", type=float, default=defaults.min_rms_db, help="Default: %(default)s")
+    parser.add_argument("--max_clipped", type=float, default=defaults.max_clipped, help="Default: %(default)s")
+    parser.add_argument("--max_silence", type=float, default=defaults.max_silence, help="Default: %(default)s")
+    parser.add_argument("--min_snr_db", type=float, default=defaults.min_snr_db, help="Default: %(default)s")
+    parser.add_argument(
+        "--cps_range", type=float, nargs=2, default=defaults.cps_range, help="Default: %(default)s times the median"
+    )
+    parser.add_argument("--io_workers", type=int, default=8, help="Threads reading the clips. Default: 8")
+    args = parser.parse_args()
+
+    quality = ClipQuality(args.min_rms_db, args.max_clipped, args.max_silence, tuple(args.cps_range), args.min_snr_db)
+    for metadata_path in args.metadata:
+        print(f"{metadata_path}: filtered metadata in {filter_metadata(metadata_path, quality, args.io_workers)}")
@@ -0,0 +1,323 @@
+"""Near duplicate clips, such as the intros, jingles and ads repeated across scraped episodes.
+
+Run it on a dataset written by format_audio_list, the train and eval metadata together so no clip of the
+eval set has a copy in the train set:
+
+    python -m utils.dedup dataset/metadata_train.csv dataset/metadata_eval.csv
+
+Each csv gets a `_dedup.csv` with one clip per group of duplicates, and duplicates_report.csv lists the
+clips left out and the clip kept in their place.
+"""
+import argparse
+import os
+import re
+import tempfile
+import unicodedata
+
+import numpy as np
+import pandas
+import torch
+import torchaudio
+
+from utils.clip_quality import analyze_clips, frame_clips
+
+# fingerprints: energy of N_BANDS bands between BAND_HZ, averaged over N_SLICES equal slices of the speech
+FRAME_MS = 32
+BAND_HZ = (200, 4000)
+N_BANDS = 16
+N_SLICES = 16
+HASH_BITS = N_BANDS * N_SLICES
+# frames this far below the loudest frame are trimmed from the ends, so cut points do not shift the slices
+TRIM_DB = -30
+FLOOR_DB = -20
+
+# items compared with the next ones of the same key, large groups are linked through chains of pairs
+PAIR_WINDOW = 64
+
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.int32)
+
+
+def _band_matrix(sample_rate, frame):
+    freqs = np.fft.rfftfreq(frame, 1 / sample_rate)
+    edges = np.geomspace(BAND_HZ[0], min(BAND_HZ[1], sample_rate / 2), N_BANDS + 1)
+    band = np.searchsorted(edges, freqs, side="right") - 1
+    matrix = np.zeros((len(freqs), N_BANDS), dtype=np.float32)
+    inside = (band >= 0) & (band < N_BANDS)
+    matrix[np.flatnonzero(inside), band[inside]] = 1
+    return matrix
+
+
+def _trim(clip, sample_rate):
+    # the clip without the ends quieter than TRIM_DB under its loudest 5 ms
+    hop = max(int(sample_rate * 0.005), 1)
+    n_hops = len(clip) // hop
+    if n_hops == 0:
+        return clip
+    energy = np.log10(np.square(clip[: n_hops * hop].reshape(n_hops, hop), dtype=np.float32).mean(axis=1) + 1e-10)
+    loud = np.flatnonzero(energy >= energy.max() + TRIM_DB / 10)
+    return clip[loud[0] * hop : (loud[-1] + 1) * hop]
+
+
+def spectral_hashes(clips, sample_rate):
+    """HASH_BITS bit fingerprints of `clips`, mono float arrays at `sample_rate`, packed as (n, 32) uint8.
+
+    The silent ends are trimmed and the frames of every clip go through one FFT and one band projection.
+    The band energies are averaged over N_SLICES slices of each clip and a bit is set when a band takes more
+    of a slice than it does on average over the clip, which does not depend on the level or the EQ of a copy.
+    """
+    clips = [_trim(clip, sample_rate) for clip in clips]
+    frame = max(int(sample_rate * FRAME_MS / 1000), 2)
+    frames, n_frames, clip_starts = frame_clips(clips, frame)
+
+    power = np.square(np.abs(np.fft.rfft(frames, axis=1))).astype(np.float32)
+    bands = power @ _band_matrix(sample_rate, frame)
+
+    hashes = np.zeros((len(clips), HASH_BITS // 8), dtype=np.uint8)
+    for i in range(len(clips)):
+        grid = bands[clip_starts[i] : clip_starts[i] + n_frames[i]]
+        if len(grid) < N_SLICES:
+            grid = np.repeat(grid, -(-N_SLICES // len(grid)), axis=0)
+        bounds = np.arange(N_SLICES + 1) * len(grid) // N_SLICES
+        sums = np.concatenate((np.zeros((1, N_BANDS)), np.cumsum(grid, axis=0, dtype=np.float64)))
+        energy = (sums[bounds[1:]] - sums[bounds[:-1]]) / np.diff(bounds)[:, None]
+        # bands down in the noise floor would flip with any noise, they are flattened to the floor
+        slices = np.log10(np.maximum(energy, energy.max() * 10 ** (FLOOR_DB / 10)) + 1e-10)
+        # without the level of each slice and each band, what is left is how the spectrum moves
+        slices -= slices.mean(axis=1, keepdims=True)
+        hashes[i] = np.packbits(slices > slices.mean(axis=0))
+    return hashes
+
+
+def hamming(hashes, i, j):
+    """Fraction of differing bits between the hashes of the clips `i` and `j`, index arrays"""
+    return _POPCOUNT[hashes[i] ^ hashes[j]].sum(axis=1) / HASH_BITS
+
+
+def normalize_text(text):
+    """Transcript for matching: NFKC, lower case, punctuation and symbols removed, single spaces"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = "".join(" " if unicodedata.category(char)[0] in "PS" else char for char in text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _window_pairs(keys, window):
+    # pairs of items with equal keys, each with the next `window` items of its key in sorted order
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    pairs = []
+    for k in range(1, min(window, len(keys) - 1) + 1):
+        same = np.flatnonzero(sorted_keys[k:] == sorted_keys[:-k])
+        if not len(same):
+            break
+        pairs.append(np.stack([order[same], order[same + k]], axis=1))
+    return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64)
+
+
+def _components(n, pairs):
+    # connected components by hooking roots to the smaller root and pointer jumping, labels are the
+    # smallest index of each component
+    labels = np.arange(n)
+    i, j = pairs[:, 0], pairs[:, 1]
+    while True:
+        low = np.minimum(labels[i], labels[j])
+        hooked = labels.copy()
+        np.minimum.at(hooked, labels[i], low)
+        np.minimum.at(hooked, labels[j], low)
+        while True:
+            jumped = hooked[hooked]
+            if np.array_equal(jumped, hooked):
+                break
+            hooked = jumped
+        if np.array_equal(hooked, labels):
+            return labels
+        labels = hooked
+
+
+class Deduplicator:
+    """Groups clips that are copies of each other.
+
+    Two clips are duplicates when their spectral hashes differ in at most `max_distance` of the bits, or
+    when their normalized transcripts are equal and at least `min_text_chars` long, in both cases with
+    durations within `duration_tolerance` of each other. Candidates come from locality sensitive hashing:
+    `n_tables` tables keyed by `table_bits` random bits of the hash, so the number of hash comparisons
+    grows with the number of clips, not its square.
+    """
+
+    def __init__(
+        self, max_distance=0.2, duration_tolerance=0.1, min_text_chars=20, n_tables=32, table_bits=12, seed=0
+    ):
+        self.max_distance = max_distance
+        self.duration_tolerance = duration_tolerance
+        self.min_text_chars = min_text_chars
+        self.n_tables = n_tables
+        self.table_bits = table_bits
+        self.seed = seed
+
+    def candidate_pairs(self, hashes, texts):
+        """`(i, j)` pairs sharing a table key or a long enough normalized transcript, encoded as i * n + j with
+        i < j and without repeats, and the transcript key of each clip"""
+        bits = np.unpackbits(hashes, axis=1)
+        rng = np.random.default_rng(self.seed)
+        weights = 1 << np.arange(self.table_bits, dtype=np.int64)
+        pairs = [
+            _window_pairs(bits[:, rng.choice(HASH_BITS, self.table_bits, replace=False)] @ weights, PAIR_WINDOW)
+            for _ in range(self.n_tables)
+        ]
+
+        normalized = pandas.Series(texts).map(normalize_text)
+        codes, _ = pandas.factorize(normalized)
+        # short texts ("yes", "thank you") are said many times without being copies
+        long_text = normalized.str.replace(" ", "", regex=False).str.len().to_numpy() >= self.min_text_chars
+        text_keys = np.where(long_text, codes, -1 - np.arange(len(codes)))
+        pairs.append(_window_pairs(text_keys, PAIR_WINDOW))
+
+        pairs = np.sort(np.concatenate(pairs), axis=1)
+        return np.unique(pairs[:, 0] * len(hashes) + pairs[:, 1]), text_keys
+
+    def groups(self, hashes, durations, texts):
+        """Label of each clip, the index of the first clip of its group of duplicates"""
+        n = len(hashes)
+        codes, text_keys = self.candidate_pairs(hashes, texts)
+        i, j = codes // n, codes % n
+        close = np.abs(durations[i] - durations[j]) <= self.duration_tolerance * np.maximum(durations[i], durations[j])
+        i, j = i[close], j[close]
+        # checked in chunks, candidates can run into the millions
+        duplicate = np.zeros(len(i), dtype=bool)
+        for start in range(0, len(i), 1 << 20):
+            chunk = slice(start, start + (1 << 20))
+            duplicate[chunk] = hamming(hashes, i[chunk], j[chunk]) <= self.max_distance
+        duplicate |= text_keys[i] == text_keys[j]
+        return _components(n, np.stack([i[duplicate], j[duplicate]], axis=1))
+
+
+def deduplicate(metadata_paths, dedup=None, io_workers=8):
+    """Fingerprint the clips of metadata csvs, keep the first clip of each group of duplicates across all of
+    them and write `<name>_dedup.csv` next to each csv, plus duplicates_report.csv next to the first.
+    Returns the deduplicated metadata paths."""
+    dedup = dedup or Deduplicator()
+    frames = [pandas.read_csv(path, sep="|") for path in metadata_paths]
+    paths = [
+        os.path.join(os.path.dirname(metadata_path), audio_file)
+        for metadata_path, df in zip(metadata_paths, frames)
+        for audio_file in df["audio_file"]
+    ]
+    texts = [text for df in frames for text in df["text"]]
+    hashes, durations = analyze_clips(paths, spectral_hashes, io_workers)
+    labels = dedup.groups(hashes.reshape(len(paths), HASH_BITS // 8), durations, texts)
+
+    keep = labels == np.arange(len(labels))
+    dropped = np.flatnonzero(~keep)
+    report = pandas.DataFrame(
+        {
+            "audio_file": np.array(paths, dtype=object)[dropped],
+            "text": np.array(texts, dtype=object)[dropped],
+            "duplicate_of": np.array(paths, dtype=object)[labels[dropped]],
+            "distance": hamming(hashes.reshape(len(paths), -1), dropped, labels[dropped]),
+        }
+    )
+    report.to_csv(os.path.join(os.path.dirname(metadata_paths[0]), "duplicates_report.csv"), sep="|", index=False)
+    print(f"Kept {keep.sum()} of {len(keep)} clips, {len(dropped)} were duplicates")
+
+    dedup_paths = []
+    offset = 0
+    for metadata_path, df in zip(metadata_paths, frames):
+        stem, _ = os.path.splitext(metadata_path)
+        dedup_paths.append(f"{stem}_dedup.csv")
+        df[keep[offset : offset + len(df)]].to_csv(dedup_paths[-1], sep="|", index=False)
+        offset += len(df)
+    return dedup_paths
+
+
+def _speech_like(seed, seconds=3.0, sample_rate=16000):
+    # 120 ms windowed tone pairs at random pitches and levels, a spectrum that moves like speech
+    rng = np.random.default_rng(seed)
+    segment = int(0.12 * sample_rate)
+    t = np.arange(segment) / sample_rate
+    parts = []
+    for _ in range(int(seconds * sample_rate) // segment):
+        f1, f2 = rng.uniform(200, 3500, 2)
+        parts.append(rng.uniform(0.2, 1) * (np.sin(2 * np.pi * f1 * t) + 0.5 * np.sin(2 * np.pi * f2 * t)))
+        parts[-1] *= np.hanning(segment)
+    return (0.3 * np.concatenate(parts)).astype(np.float32)
+
+
+def test_groups():
+    rng = np.random.default_rng(0)
+    clip = _speech_like(0)
+    clips = [
+        _speech_like(1),
+        clip,
+        0.4 * clip,
+        clip + 0.01 * rng.standard_normal(len(clip)).astype(np.float32),
+        np.concatenate([np.zeros(1600, dtype=np.float32), clip]),
+        _speech_like(2, 3.2),
+        2 * _speech_like(1),
+    ]
+    hashes = spectral_hashes(clips, 16000)
+    durations = np.array([len(clip) / 16000 for clip in clips])
+    # short distinct texts, only the audio can match
+    texts = [f"Clip {i}." for i in range(len(clips))]
+    labels = Deduplicator().groups(hashes, durations, texts)
+    # a gain change, noise or leading silence keep a copy in the group of its original, the first clip of
+    # each group represents it
+    assert labels.tolist() == [0, 1, 1, 1, 1, 5, 0], labels
+
+    # the representative only depends on the order of the clips
+    order = [4, 6, 2, 5, 0, 3, 1]
+    labels = Deduplicator().groups(hashes[order], durations[order], [texts[i] for i in order])
+    assert labels.tolist() == [0, 1, 0, 3, 1, 0, 0], labels
+    assert np.array_equal(Deduplicator().groups(hashes[order], durations[order], [texts[i] for i in order]), labels)
+
+    # equal long transcripts match whatever the audio, short ones do not
+    hashes = spectral_hashes([_speech_like(seed) for seed in range(3, 7)], 16000)
+    texts = ["The same long sentence, read twice."] * 2 + ["Yes."] * 2
+    assert Deduplicator().groups(hashes, np.full(4, 3.0), texts).tolist() == [0, 0, 2, 3]
+
+def test_deduplicate():
+    clip = _speech_like(0)
+    clips = {"a": _speech_like(1), "b": clip, "c": 0.5 * clip, "d": _speech_like(2), "e": 0.5 * _speech_like(1)}
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "wavs"))
+        for name, audio in clips.items():
+            torchaudio.save(os.path.join(tmp, "wavs", f"{name}.wav"), torch.from_numpy(audio).unsqueeze(0), 16000)
+        metadata_paths = []
+        for split, names in (("train", "abc"), ("eval", "de")):
+            metadata_paths.append(os.path.join(tmp, f"metadata_{split}.csv"))
+            pandas.DataFrame(
+                {"audio_file": [f"wavs/{name}.wav" for name in names], "text": [f"Clip {name}." for name in names]}
+            ).to_csv(metadata_paths[-1], sep="|", index=False)
+
+        dedup_paths = deduplicate(metadata_paths, io_workers=2)
+        kept = [pandas.read_csv(path, sep="|")["audio_file"].tolist() for path in dedup_paths]
+        # the copy of a train clip in the eval set goes, not the train clip
+        assert kept == [["wavs/a.wav", "wavs/b.wav"], ["wavs/d.wav"]], kept
+        report = pandas.read_csv(os.path.join(tmp, "duplicates_report.csv"), sep="|")
+        assert [os.path.basename(path) for path in report["audio_file"]] == ["c.wav", "e.wav"]
+        assert [os.path.basename(path) for path in report["duplicate_of"]] == ["b.wav", "a.wav"]
+
+
+if __name__ == "__main__":
+    defaults = Deduplicator()
+    parser = argparse.ArgumentParser(description="Remove near duplicate clips from metadata csvs")
+    parser.add_argument("metadata", nargs="+", help="Pipe delimited metadata csvs, clip paths relative to them")
+    parser.add_argument(
+        "--max_distance",
+        type=float,
+        default=defaults.max_distance,
+        help="Share of hash bits that may differ. Default: %(default)s",
+    )
+    parser.add_argument(
+        "--duration_tolerance", type=float, default=defaults.duration_tolerance, help="Default: %(default)s"
+    )
+    parser.add_argument(
+        "--min_text_chars",
+        type=int,
+        default=defaults.min_text_chars,
+        help="Shortest transcript matched on text alone. Default: %(default)s",
+    )
+    parser.add_argument("--io_workers", type=int, default=8, help="Threads reading the clips. Default: 8")
+    args = parser.parse_args()
+
+    dedup = Deduplicator(args.max_distance, args.duration_tolerance, args.min_text_chars)
+    for path in deduplicate(args.metadata, dedup, args.io_workers):
+        print(f"Wrote {path}")
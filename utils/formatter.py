@@ -1,19 +1,66 @@
+import argparse
 import gc
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+import threading
+import time
+from bisect import bisect_right
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from types import SimpleNamespace
 
+import numpy as np
 import pandas
 import torch
 import torchaudio
-from faster_whisper import WhisperModel
+from faster_whisper import decode_audio
 from tqdm import tqdm
 
 # torch.set_num_threads(1)
-from TTS.tts.layers.xtts.tokenizer import multilingual_cleaners
+from TTS.tts.layers.xtts.tokenizer import VoiceBpeTokenizer, multilingual_cleaners
+from utils.asr_pool import asr_pool
+from utils.clip_quality import STAT_COLUMNS, ClipQuality, clip_stats
+from utils.lengths import MAX_CLIP_DURATION, MIN_CLIP_DURATION, XTTS_SAMPLE_RATE, wav_length
+from utils.packed_dataset import pack, resampler
+from utils.transcript_cache import TranscriptCache, Word, transcript_cache as default_transcript_cache
+from utils.vad import EnergyVAD
 
 torch.set_num_threads(16)
 
 audio_types = (".wav", ".mp3", ".flac")
 
+WHISPER_SAMPLE_RATE = 16000
+
+# A file decoded once: `wav` is the mono waveform at the native rate `sr`, used for slicing, and
+# `whisper_audio` the same audio as 16 kHz float32 NumPy, which is what Whisper consumes. `speech_seconds`
+# is how much of it is sent to Whisper once silence is trimmed.
+DecodedAudio = namedtuple(
+    "DecodedAudio", ["path", "wav", "sr", "whisper_audio", "decode_seconds", "speech_seconds"], defaults=(None,)
+)
+
+
+def load_audio(audio_path, sample_rate=None):
+    """Decode `audio_path` once, for both slicing and Whisper, see DecodedAudio. With `sample_rate` the
+    slicing waveform is resampled to it, once for the whole file."""
+    start = time.perf_counter()
+    wav, sr = torchaudio.load(audio_path)
+    # stereo to mono if needed
+    if wav.size(0) != 1:
+        wav = torch.mean(wav, dim=0, keepdim=True)
+    wav = wav.squeeze(0)
+
+    if sr == WHISPER_SAMPLE_RATE:
+        whisper_audio = wav.numpy()  # shares memory with wav
+    else:
+        whisper_audio = resampler(sr, WHISPER_SAMPLE_RATE)(wav).numpy()
+    if sample_rate is not None and sample_rate != sr:
+        wav, sr = resampler(sr, sample_rate)(wav), sample_rate
+    return DecodedAudio(audio_path, wav, sr, whisper_audio, time.perf_counter() - start)
+
 
 def list_audios(basePath, contains=None):
     # return the set of files that are valid
@@ -40,6 +87,385 @@ def list_files(basePath, validExts=None, contains=None):
                 yield audioPath
 
 
+def _iter_words(segments):
+    # faster-whisper yields segments lazily while it decodes, pass the words on as they come
+    for segment in segments:
+        for word in segment.words:
+            yield Word(word.start, word.end, word.word, word.probability)
+
+
+def _transcribe(asr_model, audio, language):
+    segments, _ = asr_model.transcribe(audio, language=language, word_timestamps=True)
+    return _iter_words(segments)
+
+
+def _transcribe_group(asr_model, audios, language, gap_seconds):
+    # concatenate the files with silence in between, transcribe once and give each file its words back,
+    # `audios` are (DecodedAudio, audio sent to Whisper) pairs
+    gap = np.zeros(int(gap_seconds * WHISPER_SAMPLE_RATE), dtype=np.float32)
+    pieces, starts, ends = [], [], []
+    position = 0
+    for _, speech in audios:
+        starts.append(position / WHISPER_SAMPLE_RATE)
+        ends.append((position + len(speech)) / WHISPER_SAMPLE_RATE)
+        pieces += [speech, gap]
+        position += len(speech) + len(gap)
+
+    words_per_file = [[] for _ in audios]
+    for word in _transcribe(asr_model, np.concatenate(pieces), language):
+        idx = bisect_right(starts, (word.start + word.end) / 2) - 1
+        # words whose middle falls in a gap are hallucinated on silence
+        if idx < 0 or (word.start + word.end) / 2 >= ends[idx]:
+            continue
+        start, duration = starts[idx], ends[idx] - starts[idx]
+        words_per_file[idx].append(
+            Word(max(word.start - start, 0), min(word.end - start, duration), word.word, word.probability)
+        )
+    return [audio for audio, _ in audios], words_per_file
+
+
+def _store_words(words, cache, key, **meta):
+    # pass the words through and cache them once the transcription is complete
+    collected = []
+    for word in words:
+        collected.append(word)
+        yield word
+    cache.put(key, collected, **meta)
+
+
+def _prefetch(fn, items, pool, depth):
+    # yield fn(item) in order while up to `depth` of the following items are computed in `pool`
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) > depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def iter_transcriptions(
+    asr_model,
+    audio_files,
+    language,
+    batch_size=0,
+    group_seconds=300,
+    gap_seconds=2.0,
+    decode_pool=None,
+    decode_ahead=2,
+    cache=None,
+    cache_keys=None,
+    cache_meta=None,
+    vad=None,
+    sample_rate=None,
+    cached_words=None,
+):
+    """Yield `(audio, words)` for every file, `audio` being the file's DecodedAudio.
+
+    Each file is decoded once, by load_audio, up to `decode_ahead` files ahead of the ASR in `decode_pool`
+    when one is given. Without `batch_size` each file is transcribed on its own and `words` is a generator
+    that follows faster-whisper's lazy decoding, it must be consumed before the next file is requested. With
+    `batch_size`, files are concatenated, with `gap_seconds` of silence in between, into groups of about
+    `group_seconds`, so short clips share Whisper's 30 second windows instead of each being padded to a full
+    one. faster-whisper 1.0.3, the version this repo pins, has no batched pipeline, so the windows of a group
+    are still decoded one after the other.
+
+    With a TranscriptCache, the words of files whose path has a key in `cache_keys` are looked up in `cache`
+    and stored there, with `cache_meta`, once transcribed, unless `cached_words` already has their words by
+    path. Files are yielded in order, except that cached files do not wait for the batched group they would
+    have been part of.
+
+    With an EnergyVAD as `vad`, only the speech of each file is sent to Whisper, word times are mapped back
+    to the original audio and the audio's `speech_seconds` tells how much was kept. `sample_rate` is passed
+    to load_audio.
+    """
+
+    def load(audio_path):
+        audio = load_audio(audio_path, sample_rate)
+        if vad is None:
+            return audio._replace(speech_seconds=len(audio.whisper_audio) / WHISPER_SAMPLE_RATE), None, None
+        speech, timeline = vad.trim(audio.whisper_audio, WHISPER_SAMPLE_RATE)
+        return audio._replace(speech_seconds=timeline.speech_seconds), speech, timeline
+
+    if decode_pool is not None:
+        loaded = _prefetch(load, audio_files, decode_pool, depth=decode_ahead)
+    else:
+        loaded = map(load, audio_files)
+    cache_keys = cache_keys if cache is not None and cache_keys else {}
+    cache_meta = cache_meta or {}
+    cached_words = cached_words or {}
+
+    def transcribe_group(group):
+        timelines = [timeline for _, _, timeline in group]
+        audios, words_per_file = _transcribe_group(
+            asr_model, [(audio, speech) for audio, speech, _ in group], language, gap_seconds
+        )
+        for audio, words, timeline in zip(audios, words_per_file, timelines):
+            if timeline is not None:
+                words = list(timeline.map_words(words))
+            if audio.path in cache_keys:
+                cache.put(cache_keys[audio.path], words, **cache_meta)
+            yield audio, words
+
+    group, group_length = [], 0
+    for audio, speech, timeline in loaded:
+        key = cache_keys.get(audio.path)
+        words = cached_words.pop(audio.path, None)
+        if words is None and key is not None:
+            words = cache.get(key)
+        if speech is None:
+            speech = audio.whisper_audio
+        if words is not None:
+            yield audio, words
+        elif len(speech) == 0:
+            # nothing but silence
+            if key is not None:
+                cache.put(key, [], **cache_meta)
+            yield audio, []
+        elif not batch_size:
+            words = _transcribe(asr_model, speech, language)
+            if timeline is not None:
+                words = timeline.map_words(words)
+            yield audio, _store_words(words, cache, key, **cache_meta) if key is not None else words
+        else:
+            group.append((audio, speech, timeline))
+            group_length += len(speech) / WHISPER_SAMPLE_RATE + gap_seconds
+            if group_length >= group_seconds:
+                yield from transcribe_group(group)
+                group, group_length = [], 0
+    if group:
+        yield from transcribe_group(group)
+
+
+SENTENCE_END = ("!", ".", "?", "।", "॥")
+# a sentence end can be followed by closing quotes or brackets, "end." or (end.)
+_closing_chars = "\"')]}»”’ "
+_pause_chars = (",", ";", ":", "،", "—")
+
+
+def _cut_times(starts, ends, first, last, duration, buffer):
+    # clip boundaries of the sentences made of words first[k]..last[k]: `buffer` around the words, at most
+    # halfway to the neighbouring words, and the file start or end for the first and last word
+    previous_end = np.concatenate(([0.0], ends[:-1]))
+    next_start = np.concatenate((starts[1:], [duration]))
+    clip_starts = np.maximum(
+        starts[first] - buffer, np.where(first == 0, 0.0, (previous_end[first] + starts[first]) / 2)
+    )
+    clip_ends = np.minimum((ends[last] + next_start[last]) / 2, ends[last] + buffer)
+    return clip_starts, clip_ends
+
+
+def _split_sentence(starts, ends, texts, first, last, max_duration, duration, buffer):
+    # split the sentence of words first..last at its widest pause, preferring pauses after a comma or
+    # similar and then the middle of the sentence, until every piece fits in `max_duration`
+    clip_start, clip_end = _cut_times(starts, ends, np.array([first]), np.array([last]), duration, buffer)
+    if clip_end[0] - clip_start[0] <= max_duration or first == last:
+        return [(first, last)]
+    inner = np.arange(first, last)
+    pauses = starts[inner + 1] - ends[inner] + np.array([texts[i].rstrip()[-1:] in _pause_chars for i in inner])
+    pauses -= 0.01 * np.abs(inner - (first + last) / 2) / (last - first)
+    split = int(inner[np.argmax(pauses)])
+    return _split_sentence(starts, ends, texts, first, split, max_duration, duration, buffer) + _split_sentence(
+        starts, ends, texts, split + 1, last, max_duration, duration, buffer
+    )
+
+
+def _pack_spans(starts, ends, first, last, clip_starts, clip_ends, target_duration, max_gap, max_duration):
+    # merge consecutive spans of words while that brings the clip closer to `target_duration`, never past
+    # `max_duration` or across a pause longer than `max_gap`. A clip of the spans a..b runs from the start of
+    # span a to the end of span b, so the lengths come from the cut times of the single spans
+    groups = [[0, 0]]
+    for k in range(1, len(first)):
+        a, b = groups[-1]
+        current = clip_ends[b] - clip_starts[a]
+        merged = clip_ends[k] - clip_starts[a]
+        gap = starts[first[k]] - ends[last[b]]
+        fits = not max_duration or merged <= max_duration
+        closer = merged - target_duration < target_duration - current
+        if gap <= max_gap and fits and closer:
+            groups[-1][1] = k
+        else:
+            groups.append([k, k])
+    groups = np.array(groups)
+    return first[groups[:, 0]], last[groups[:, 1]]
+
+
+def segment_sentences(
+    words,
+    duration,
+    buffer,
+    min_duration=MIN_CLIP_DURATION,
+    max_duration=MAX_CLIP_DURATION,
+    target_duration=None,
+    max_gap=1.0,
+):
+    """Cut a file's words into sentences, returns `(start, end, text)` in seconds for each clip.
+
+    A clip starts `buffer` before its first word, or halfway from the previous word if that is closer, and
+    ends `buffer` after its last word, or halfway to the next word (the end of the audio, `duration`, for the
+    last one). Sentences longer than `max_duration` are split at pauses, clips shorter than `min_duration`
+    (a single word longer than `max_duration`) are dropped, and so are words after the last sentence end.
+
+    With a `target_duration`, consecutive sentences are packed into one clip as long as that brings it closer
+    to the target, without going over `max_duration` or across a pause longer than `max_gap` seconds, so
+    training gets fewer, fuller samples.
+    """
+    words = list(words)
+    if not words:
+        return []
+    starts = np.array([word.start for word in words], dtype=np.float64)
+    ends = np.array([word.end for word in words], dtype=np.float64)
+    texts = [word.word for word in words]
+    is_end = np.fromiter((text.rstrip(_closing_chars)[-1:] in SENTENCE_END for text in texts), bool, len(texts))
+
+    last = np.flatnonzero(is_end)
+    if not len(last):
+        return []
+    first = np.concatenate(([0], last[:-1] + 1))
+    clip_starts, clip_ends = _cut_times(starts, ends, first, last, duration, buffer)
+    if max_duration and (clip_ends - clip_starts > max_duration).any():
+        spans = []
+        for k in range(len(first)):
+            if clip_ends[k] - clip_starts[k] > max_duration:
+                spans += _split_sentence(starts, ends, texts, first[k], last[k], max_duration, duration, buffer)
+            else:
+                spans.append((first[k], last[k]))
+        first, last = np.array(spans, dtype=np.int64).T
+        clip_starts, clip_ends = _cut_times(starts, ends, first, last, duration, buffer)
+    if target_duration and len(first) > 1:
+        first, last = _pack_spans(
+            starts, ends, first, last, clip_starts, clip_ends, target_duration, max_gap, max_duration
+        )
+        clip_starts, clip_ends = _cut_times(starts, ends, first, last, duration, buffer)
+
+    lengths = clip_ends - clip_starts
+    keep = lengths >= min_duration
+    if max_duration:
+        keep &= lengths <= max_duration
+    return [
+        # words carry the space before them, if the language has one
+        (clip_starts[k], clip_ends[k], "".join(texts[first[k] : last[k] + 1]).strip())
+        for k in np.flatnonzero(keep)
+    ]
+
+
+class ClipWriter:
+    """Writes clips from a thread pool so encoding and disk I/O overlap with the ASR.
+
+    At most `max_pending` clips wait to be written, submit blocks beyond that so memory stays bounded. Clips
+    are float WAVs, or 16 bit PCM, half the size, with `pcm16`.
+    """
+
+    def __init__(self, workers=4, max_pending=64, pcm16=False):
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._futures = deque()
+        self._save_kwargs = {"encoding": "PCM_S", "bits_per_sample": 16} if pcm16 else {}
+
+    def _write(self, path, audio, sr):
+        try:
+            torchaudio.save(path, audio, sr, **self._save_kwargs)
+        finally:
+            self._slots.release()
+
+    def submit(self, path, audio, sr):
+        self._slots.acquire()
+        self._futures.append(self._pool.submit(self._write, path, audio, sr))
+        # drop finished futures, raising the first error early
+        while self._futures and self._futures[0].done():
+            self._futures.popleft().result()
+
+    def flush(self):
+        """Wait until every submitted clip is on disk"""
+        while self._futures:
+            self._futures.popleft().result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown()
+
+
+MANIFEST_NAME = "manifest.json"
+# 2: rows also record the clip length in samples and its sample rate, 3: and its quality statistics, 4: rows
+# keep the text as transcribed and entries their language, the text is cleaned when the metadata is written,
+# 5: sources are named by their path under the audio folder, 6: keys also cover the source name, 7: rows record
+# the clip's SNR
+MANIFEST_VERSION = 7
+MANIFEST_ROW_COLUMNS = ["audio_file", "text", "num_samples", "sample_rate"] + STAT_COLUMNS
+
+# columns of the metadata csvs, the coqui formatter only reads the first three and ignores the others
+METADATA_COLUMNS = ["audio_file", "text", "speaker_name", "duration", "wav_length", "text_length"]
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_name(audio_path, audio_root=None):
+    """Name of a source in the manifest and in its clip names: its path relative to `audio_root`, with /
+    separators, or without `audio_root` its file name, in both cases without the extension"""
+    if audio_root is not None:
+        name = os.path.relpath(audio_path, audio_root).replace(os.sep, "/")
+    else:
+        name = os.path.basename(audio_path)
+    return os.path.splitext(name)[0]
+
+
+def manifest_key(content_hash, settings, source):
+    """Manifest entry key, the source content hash plus everything the clips of that source depend on, its
+    name included: clips are named after it, a renamed or copied file needs clips of its own"""
+    settings = dict(settings, source=source)
+    settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"{content_hash}-{settings_hash[:16]}"
+
+
+def load_manifest(path):
+    """The dataset manifest, `{"version", "files": {key: {"source", "language", "duration", "rows"}}}`, empty if
+    missing. A row holds the MANIFEST_ROW_COLUMNS of a clip."""
+    if os.path.isfile(path):
+        with open(path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") == MANIFEST_VERSION:
+            return manifest
+        print(f"Ignoring {path}, it was written by another version of the formatter")
+    return {"version": MANIFEST_VERSION, "files": {}}
+
+
+def save_manifest(manifest, path):
+    # write then rename, so an interrupted run never leaves a truncated manifest
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _split_fraction(audio_file, seed=None):
+    # stable pseudo random number in [0, 1) per clip, a clip stays in the same split when the dataset grows
+    if seed is not None:
+        audio_file = f"{seed}:{audio_file}"
+    digest = hashlib.sha256(audio_file.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64
+
+
+def split_metadata(df, eval_percentage, seed=None):
+    """Deterministic train/eval split of a metadata frame, both sorted by audio_file, `seed` picks another
+    split"""
+    fractions = df["audio_file"].map(lambda audio_file: _split_fraction(audio_file, seed))
+    is_eval = fractions < eval_percentage
+    # small datasets still get one eval sample
+    if eval_percentage > 0 and len(df) > 1 and not is_eval.any():
+        is_eval[fractions.idxmin()] = True
+    df_train = df[~is_eval].sort_values("audio_file")
+    df_eval = df[is_eval].sort_values("audio_file")
+    return df_train, df_eval
+
+
 def format_audio_list(
     audio_files,
     target_language="en",
@@ -48,114 +474,719 @@ def format_audio_list(
     eval_percentage=0.15,
     speaker_name="coqui",
     gradio_progress=None,
+    asr_model=None,
+    whisper_model="large-v2",
+    batch_size=0,
+    io_workers=4,
+    checkpoint_seconds=60,
+    transcript_cache=default_transcript_cache,
+    min_duration=MIN_CLIP_DURATION,
+    max_duration=MAX_CLIP_DURATION,
+    vad=True,
+    sample_rate=None,
+    pcm16=False,
+    packed=False,
+    seed=None,
+    vocab_file=None,
+    quality=None,
+    target_duration=None,
+    max_gap=1.0,
+    audio_root=None,
 ):
-    audio_total_size = 0
-    # make sure that ooutput file exists
-    os.makedirs(out_path, exist_ok=True)
+    """Transcribe and slice `audio_files` into a coqui formatted dataset in `out_path`.
 
-    # Loading Whisper
-    device = "cuda" if torch.cuda.is_available() else "cpu"
+    The clips are built by build_clips, see there for the options, then the metadata of the whole dataset is
+    written by write_metadata, with the token counts of the texts when the XTTS `vocab_file` is given and
+    without the clips failing the thresholds of a ClipQuality `quality`, by default every clip is kept. Returns
+    the metadata paths and the total duration of the dataset in seconds.
+    """
+    manifest = build_clips(
+        audio_files,
+        out_path,
+        target_language=target_language,
+        buffer=buffer,
+        gradio_progress=gradio_progress,
+        asr_model=asr_model,
+        whisper_model=whisper_model,
+        batch_size=batch_size,
+        io_workers=io_workers,
+        checkpoint_seconds=checkpoint_seconds,
+        transcript_cache=transcript_cache,
+        min_duration=min_duration,
+        max_duration=max_duration,
+        vad=vad,
+        sample_rate=sample_rate,
+        pcm16=pcm16,
+        target_duration=target_duration,
+        max_gap=max_gap,
+        audio_root=audio_root,
+    )
+    return write_metadata(
+        out_path,
+        manifest,
+        eval_percentage,
+        seed=seed,
+        packed=packed,
+        sample_rate=sample_rate,
+        language=target_language,
+        speaker_name=speaker_name,
+        vocab_file=vocab_file,
+        quality=quality,
+    )
 
-    print("Loading Whisper Model!")
-    asr_model = WhisperModel("large-v2", device=device, compute_type="float16")
 
-    metadata = {"audio_file": [], "text": [], "speaker_name": []}
+def build_clips(
+    audio_files,
+    out_path,
+    manifest_name=MANIFEST_NAME,
+    target_language="en",
+    buffer=0.2,
+    gradio_progress=None,
+    asr_model=None,
+    whisper_model="large-v2",
+    batch_size=0,
+    io_workers=4,
+    checkpoint_seconds=60,
+    transcript_cache=default_transcript_cache,
+    min_duration=MIN_CLIP_DURATION,
+    max_duration=MAX_CLIP_DURATION,
+    vad=True,
+    sample_rate=None,
+    pcm16=False,
+    asr_options=None,
+    target_duration=None,
+    max_gap=1.0,
+    audio_root=None,
+):
+    """Transcribe and slice `audio_files` into clips under `out_path`/wavs, returns the updated manifest.
 
-    if gradio_progress is not None:
-        tqdm_object = gradio_progress.tqdm(audio_files, desc="Formatting...")
-    else:
-        tqdm_object = tqdm(audio_files)
+    Uses `asr_model` if given, otherwise borrows `whisper_model`, loaded with the ASRModelPool.acquire
+    `asr_options`, from the process wide ASR model pool, so consecutive runs do not reload it. A `batch_size`
+    transcribes many files together, see iter_transcriptions. The next files are decoded and finished clips
+    are written by `io_workers` threads each while the ASR runs.
 
-    for audio_path in tqdm_object:
-        wav, sr = torchaudio.load(audio_path)
-        # stereo to mono if needed
-        if wav.size(0) != 1:
-            wav = torch.mean(wav, dim=0, keepdim=True)
+    Builds are incremental: the clips of every source are recorded in the manifest `manifest_name` in
+    `out_path` under the hash of its content and of the settings they depend on (`whisper_model`, language,
+    buffer...), so files that were already processed with the same settings are skipped and their clips
+    reused. A file that changed is processed again and replaces its old clips, and sources that are no longer
+    given stay in the dataset. The manifest is saved every `checkpoint_seconds`, so an interrupted run resumes
+    where it stopped. Sources are told apart by their path under `audio_root`, the folder the files were
+    listed from, or by their file name when it is None (see source_name), their clips go to the same path
+    under `out_path`/wavs.
 
-        wav = wav.squeeze()
-        audio_total_size += wav.size(-1) / sr
-
-        segments, _ = asr_model.transcribe(audio_path, word_timestamps=True, language=target_language)
-        segments = list(segments)
-        i = 0
-        sentence = ""
-        sentence_start = None
-        first_word = True
-        # added all segments words in a unique list
-        words_list = []
-        for _, segment in enumerate(segments):
-            words = list(segment.words)
-            words_list.extend(words)
-
-        # process each word
-        for word_idx, word in enumerate(words_list):
-            if first_word:
-                sentence_start = word.start
-                # If it is the first sentence, add buffer or get the begining of the file
-                if word_idx == 0:
-                    sentence_start = max(sentence_start - buffer, 0)  # Add buffer to the sentence start
-                else:
-                    # get previous sentence end
-                    previous_word_end = words_list[word_idx - 1].end
-                    # add buffer or get the silence midle between the previous sentence and the current one
-                    sentence_start = max(sentence_start - buffer, (previous_word_end + sentence_start) / 2)
-
-                sentence = word.word
-                first_word = False
-            else:
-                sentence += word.word
+    Clips are cut at sentence ends and kept between `min_duration` and `max_duration` seconds, see
+    segment_sentences, match them to train_gpt's `max_audio_length` so the trainer keeps every clip. With a
+    `target_duration`, consecutive sentences not `max_gap` seconds apart are packed into clips close to it.
+
+    Silence is trimmed by `vad` before the ASR, an EnergyVAD, True for the default one or None to disable it.
 
-            if word.word[-1] in ["!", ".", "?"]:
-                sentence = sentence[1:]
-                # Expand number and abbreviations plus normalization
-                sentence = multilingual_cleaners(sentence, target_language)
-                audio_file_name, _ = os.path.splitext(os.path.basename(audio_path))
+    Clips keep the source sample rate unless `sample_rate` is given. Writing them at XTTS_SAMPLE_RATE saves
+    the trainer resampling every clip in every epoch, the source is resampled once per file here instead.
+    `pcm16` writes 16 bit clips instead of float ones.
 
-                audio_file = f"wavs/{audio_file_name}_{str(i).zfill(8)}.wav"
+    The words Whisper returns are kept in `transcript_cache` (None disables it), so changing only the buffer or
+    the split replays the segmentation without running the ASR again. Clips keep the text as transcribed, the
+    cleaners are applied by write_metadata, a new cleaner needs neither the ASR nor slicing.
+    """
+    # make sure that ooutput file exists
+    os.makedirs(os.path.join(out_path, "wavs"), exist_ok=True)
+    manifest_path = os.path.join(out_path, manifest_name)
+    manifest = load_manifest(manifest_path)
+    entries = manifest["files"]
+    vad = EnergyVAD() if vad is True else vad or None
 
-                # Check for the next word's existence
-                if word_idx + 1 < len(words_list):
-                    next_word_start = words_list[word_idx + 1].start
-                else:
-                    # If don't have more words it means that it is the last sentence then use the audio len as next word start
-                    next_word_start = (wav.shape[0] - 1) / sr
+    settings = {
+        "whisper_model": whisper_model,
+        "language": target_language,
+        "buffer": buffer,
+        "min_duration": min_duration,
+        "max_duration": max_duration,
+        "vad": vad.settings() if vad is not None else None,
+        "sample_rate": sample_rate,
+        "pcm16": pcm16,
+        "target_duration": target_duration,
+        "max_gap": max_gap,
+    }
+    sources = {audio_path: source_name(audio_path, audio_root) for audio_path in audio_files}
+    clashes = sorted(name for name, count in Counter(sources.values()).items() if count > 1)
+    if clashes:
+        raise ValueError(
+            f"Several audio files would be named {', '.join(clashes[:5])} in the dataset, give the folder they "
+            f"were listed from as audio_root"
+        )
+    with ThreadPoolExecutor(max_workers=io_workers) as hash_pool:
+        content_hashes = list(hash_pool.map(file_hash, audio_files))
 
-                # Average the current word end and next word start
-                word_end = min((word.end + next_word_start) / 2, word.end + buffer)
+    keys = {
+        audio_path: manifest_key(content_hash, settings, sources[audio_path])
+        for audio_path, content_hash in zip(audio_files, content_hashes)
+    }
+    # a given source whose content or settings changed gets new clips under the same names, its old entry is
+    # dropped first, before anything is skipped
+    wanted = set(keys.values())
+    given = set(sources.values())
+    for old_key in [k for k, entry in entries.items() if entry["source"] in given and k not in wanted]:
+        for row in entries.pop(old_key)["rows"]:
+            old_path = os.path.join(out_path, row[0])
+            if os.path.isfile(old_path):
+                os.remove(old_path)
 
-                absoulte_path = os.path.join(out_path, audio_file)
-                os.makedirs(os.path.dirname(absoulte_path), exist_ok=True)
-                i += 1
-                first_word = True
+    todo, todo_keys, cache_keys = [], {}, {}
+    for audio_path, content_hash in zip(audio_files, content_hashes):
+        key = keys[audio_path]
+        if key in entries or key in todo_keys.values():
+            continue
+        todo.append(audio_path)
+        todo_keys[audio_path] = key
+        # words of batched groups can differ a little from per file transcription, they are cached apart
+        cache_keys[audio_path] = TranscriptCache.key(
+            content_hash,
+            whisper_model,
+            target_language,
+            vad=vad.settings() if vad is not None else None,
+            packed=bool(batch_size),
+        )
+    print(f"{len(audio_files) - len(todo)} of {len(audio_files)} files are already in the dataset")
+    # the dropped clips are gone from disk, so are their entries
+    save_manifest(manifest, manifest_path)
 
-                audio = wav[int(sr * sentence_start) : int(sr * word_end)].unsqueeze(0)
-                # if the audio is too short ignore it (i.e < 0.33 seconds)
-                if audio.size(-1) >= sr / 3:
-                    torchaudio.save(absoulte_path, audio, sr)
-                else:
-                    continue
+    if todo:
+        # Whisper is only loaded when some transcript is not cached. The words are read once, here, so an entry
+        # evicted before its file is sliced does not leave that file without transcript and without model
+        cached_words = {}
+        if asr_model is None and transcript_cache is not None:
+            for audio_path in todo:
+                words = transcript_cache.get(cache_keys[audio_path])
+                if words is None:
+                    break
+                cached_words[audio_path] = words
+        if asr_model is None and len(cached_words) < len(todo):
+            model_context = asr_pool.model(whisper_model, **(asr_options or {}))
+        else:
+            model_context = nullcontext(asr_model)
+        with model_context as asr_model:
+            _slice_audio_files(
+                todo,
+                keys=todo_keys,
+                sources=sources,
+                cache_keys=cache_keys,
+                cache=transcript_cache,
+                cached_words=cached_words,
+                whisper_model=whisper_model,
+                manifest=manifest,
+                manifest_path=manifest_path,
+                asr_model=asr_model,
+                target_language=target_language,
+                out_path=out_path,
+                buffer=buffer,
+                min_duration=min_duration,
+                max_duration=max_duration,
+                gradio_progress=gradio_progress,
+                batch_size=batch_size,
+                io_workers=io_workers,
+                checkpoint_seconds=checkpoint_seconds,
+                vad=vad,
+                sample_rate=sample_rate,
+                pcm16=pcm16,
+                target_duration=target_duration,
+                max_gap=max_gap,
+            )
+        save_manifest(manifest, manifest_path)
 
-                metadata["audio_file"].append(audio_file)
-                metadata["text"].append(sentence)
-                metadata["speaker_name"].append(speaker_name)
+    return manifest
 
-    df = pandas.DataFrame(metadata)
-    df = df.sample(frac=1)
-    num_val_samples = int(len(df) * eval_percentage)
 
-    df_eval = df[:num_val_samples]
-    df_train = df[num_val_samples:]
+def write_metadata(
+    out_path,
+    manifest,
+    eval_percentage=0.15,
+    seed=None,
+    packed=False,
+    sample_rate=None,
+    language=None,
+    speaker_name="coqui",
+    vocab_file=None,
+    quality=None,
+):
+    """Write metadata_train.csv and metadata_eval.csv of every clip of the manifest, split by split_metadata.
+
+    Texts are cleaned by multilingual_cleaners in the language of their source and every clip gets
+    `speaker_name` here rather than when it is sliced, so a fixed cleaner or another speaker name applies to the
+    whole dataset on the next write without slicing anything again.
+    Besides audio_file, text and speaker_name, each clip gets its duration in seconds, its wav_length (see
+    wav_length) and, with the XTTS `vocab_file` and the `language`, its text_length in BPE tokens, -1 without
+    them. utils.lengths.filter_by_length uses them to drop the clips the trainer would skip without loading any.
+    With a ClipQuality `quality`, the clips failing its thresholds are left out of both csvs and every clip's
+    statistics and verdict go to quality_report.csv.
+    With `packed`, the train and eval clips are also packed into packed_train and packed_eval (see
+    utils.packed_dataset), and those folders are returned instead of the metadata csvs, train_gpt takes both.
+    The wavs stay, incremental builds reuse them. Returns the metadata paths and the total duration of the
+    dataset in seconds.
+    """
+    entries = manifest["files"]
+    rows = [row for entry in entries.values() for row in entry["rows"]]
+    df = pandas.DataFrame(rows, columns=MANIFEST_ROW_COLUMNS)
+    # Expand number and abbreviations plus normalization
+    languages = [entry["language"] for entry in entries.values() for _ in entry["rows"]]
+    df["text"] = [multilingual_cleaners(text, language) for text, language in zip(df["text"], languages)]
+    df["speaker_name"] = speaker_name
+    df["duration"] = df["num_samples"] / df["sample_rate"]
+    if quality is not None and len(df):
+        df, report = quality.filter(df)
+        report[["audio_file", "text", "duration", "cps", *STAT_COLUMNS, "dropped"]].to_csv(
+            os.path.join(out_path, "quality_report.csv"), sep="|", index=False
+        )
+    df["wav_length"] = wav_length(df["num_samples"], df["sample_rate"])
+    if vocab_file is not None and language is not None:
+        tokenizer = VoiceBpeTokenizer(vocab_file)
+        df["text_length"] = [len(tokenizer.encode(text, language)) for text in df["text"]]
+    else:
+        df["text_length"] = -1
+    df = df[METADATA_COLUMNS]
+    df_train, df_eval = split_metadata(df, eval_percentage, seed)
 
-    df_train = df_train.sort_values("audio_file")
     train_metadata_path = os.path.join(out_path, "metadata_train.csv")
     df_train.to_csv(train_metadata_path, sep="|", index=False)
 
     eval_metadata_path = os.path.join(out_path, "metadata_eval.csv")
-    df_eval = df_eval.sort_values("audio_file")
     df_eval.to_csv(eval_metadata_path, sep="|", index=False)
 
-    # deallocate VRAM and RAM
-    del asr_model, df_train, df_eval, df, metadata
+    if packed:
+        packed_rate = sample_rate or XTTS_SAMPLE_RATE
+        pack(train_metadata_path, os.path.join(out_path, "packed_train"), packed_rate)
+        pack(eval_metadata_path, os.path.join(out_path, "packed_eval"), packed_rate)
+        train_metadata_path = os.path.join(out_path, "packed_train")
+        eval_metadata_path = os.path.join(out_path, "packed_eval")
+
+    audio_total_size = sum(entry["duration"] for entry in entries.values())
+
+    # deallocate RAM
+    del df_train, df_eval, df, rows
     gc.collect()
 
     return train_metadata_path, eval_metadata_path, audio_total_size
+
+
+def _slice_audio_files(
+    audio_files,
+    *,
+    keys,
+    sources,
+    cache_keys,
+    cache,
+    cached_words,
+    whisper_model,
+    manifest,
+    manifest_path,
+    asr_model,
+    target_language,
+    out_path,
+    buffer,
+    min_duration,
+    max_duration,
+    gradio_progress,
+    batch_size,
+    io_workers,
+    checkpoint_seconds,
+    vad,
+    sample_rate,
+    pcm16,
+    target_duration,
+    max_gap,
+):
+    # transcribe and slice `audio_files`, recording the clips of each one under its key in the manifest
+    audio_total_size = 0
+    decode_pool = ThreadPoolExecutor(max_workers=io_workers)
+    writer = ClipWriter(workers=io_workers, pcm16=pcm16)
+
+    transcriptions = iter_transcriptions(
+        asr_model,
+        audio_files,
+        target_language,
+        batch_size=batch_size,
+        decode_pool=decode_pool,
+        cache=cache,
+        cache_keys=cache_keys,
+        cache_meta={"model": whisper_model, "language": target_language},
+        vad=vad,
+        sample_rate=sample_rate,
+        cached_words=cached_words,
+    )
+    if gradio_progress is not None:
+        tqdm_object = gradio_progress.tqdm(transcriptions, total=len(audio_files), desc="Formatting...")
+    else:
+        tqdm_object = tqdm(transcriptions, total=len(audio_files))
+
+    start_time = last_checkpoint = time.perf_counter()
+    decode_seconds = 0
+    speech_seconds = 0
+    cache_hits = cache.hits if cache is not None else 0
+    try:
+        for decoded, words_list in tqdm_object:
+            audio_path, wav, sr = decoded.path, decoded.wav, decoded.sr
+            audio_total_size += wav.size(-1) / sr
+            decode_seconds += decoded.decode_seconds
+            speech_seconds += decoded.speech_seconds
+            source = sources[audio_path]
+            os.makedirs(os.path.dirname(os.path.join(out_path, f"wavs/{source}")), exist_ok=True)
+            rows = []
+            clips = []
+
+            sentences = segment_sentences(
+                words_list, (wav.shape[0] - 1) / sr, buffer, min_duration, max_duration, target_duration, max_gap
+            )
+            for i, (sentence_start, word_end, sentence) in enumerate(sentences):
+                audio_file = f"wavs/{source}_{str(i).zfill(8)}.wav"
+                absoulte_path = os.path.join(out_path, audio_file)
+
+                audio = wav[int(sr * sentence_start) : int(sr * word_end)].unsqueeze(0)
+                writer.submit(absoulte_path, audio, sr)
+                rows.append([audio_file, sentence, audio.size(-1), sr])
+                clips.append(audio[0].numpy())
+
+            # the clips are still in memory, their statistics are one batch per source file
+            if clips:
+                for row, stats in zip(rows, clip_stats(clips, sr)):
+                    row.extend(round(float(value), 5) for value in stats)
+
+            manifest["files"][keys[audio_path]] = {
+                "source": source,
+                "language": target_language,
+                "duration": wav.size(-1) / sr,
+                "rows": rows,
+            }
+            if time.perf_counter() - last_checkpoint > checkpoint_seconds:
+                # only record files whose clips are all written
+                writer.flush()
+                save_manifest(manifest, manifest_path)
+                last_checkpoint = time.perf_counter()
+    finally:
+        writer.close()
+        decode_pool.shutdown(cancel_futures=True)
+
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    print(
+        f"Processed {audio_total_size:.1f}s of audio in {elapsed:.1f}s "
+        f"({audio_total_size / elapsed:.1f} audio seconds per second), "
+        f"decoding took {decode_seconds:.1f}s ({decode_seconds / max(len(audio_files), 1):.2f}s per file)"
+    )
+    if cache is not None:
+        print(f"{cache.hits - cache_hits} of {len(audio_files)} transcripts came from the cache")
+    if vad is not None and audio_total_size:
+        skipped = audio_total_size - speech_seconds
+        # ASR time grows with the audio length, estimate what the skipped part would have cost at this run's speed
+        saved = skipped * elapsed / max(speech_seconds, 1e-9)
+        print(
+            f"Silence trimming skipped {skipped:.1f}s ({100 * skipped / audio_total_size:.1f}%) of the audio, "
+            f"saving about {saved:.1f}s of ASR"
+        )
+
+
+def benchmark_decoding(audio_files):
+    """Print per file decode seconds of load_audio against decoding twice, for slicing and again inside Whisper"""
+    print(f"{'file':<40}{'twice (s)':>12}{'once (s)':>12}")
+    for audio_path in audio_files:
+        start = time.perf_counter()
+        wav, sr = torchaudio.load(audio_path)
+        if wav.size(0) != 1:
+            wav = torch.mean(wav, dim=0, keepdim=True)
+        decode_audio(audio_path, sampling_rate=WHISPER_SAMPLE_RATE)
+        twice = time.perf_counter() - start
+        once = load_audio(audio_path).decode_seconds
+        print(f"{os.path.basename(audio_path)[-40:]:<40}{twice:>12.3f}{once:>12.3f}")
+
+
+def benchmark_clip_loading(metadata_paths, sample_rate=XTTS_SAMPLE_RATE):
+    """Time loading every clip of the metadata files the way the XTTS trainer does, once per epoch"""
+    from TTS.tts.models.xtts import load_audio as load_training_audio
+
+    clips = []
+    for metadata_path in metadata_paths:
+        df = pandas.read_csv(metadata_path, sep="|")
+        clips += [os.path.join(os.path.dirname(metadata_path), audio_file) for audio_file in df["audio_file"]]
+    start = time.perf_counter()
+    n_bytes = 0
+    for clip in clips:
+        load_training_audio(clip, sample_rate)
+        n_bytes += os.path.getsize(clip)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Loaded {len(clips)} clips ({n_bytes / 1024**2:.1f} MB) in {elapsed:.2f}s, "
+        f"{1000 * elapsed / max(len(clips), 1):.2f}ms per clip"
+    )
+    return elapsed
+
+
+def benchmark_vad(audio_files, whisper_model=None, language=None, vad=None):
+    """Print the share of each file trimmed by the VAD, and with `whisper_model` the ASR time with and without
+    trimming"""
+    vad = vad or EnergyVAD()
+    model_context = asr_pool.model(whisper_model) if whisper_model else nullcontext()
+    with model_context as asr_model:
+        header = f"{'file':<40}{'audio (s)':>11}{'skipped':>9}"
+        if asr_model is not None:
+            header += f"{'asr full (s)':>14}{'asr vad (s)':>13}"
+        print(header)
+        totals = np.zeros(4)
+        for audio_path in audio_files:
+            audio = load_audio(audio_path).whisper_audio
+            speech, timeline = vad.trim(audio, WHISPER_SAMPLE_RATE)
+            row = [timeline.total_seconds, timeline.total_seconds - timeline.speech_seconds, 0, 0]
+            line = f"{os.path.basename(audio_path)[-40:]:<40}{row[0]:>11.1f}{100 * row[1] / max(row[0], 1e-9):>8.1f}%"
+            if asr_model is not None:
+                for i, samples in ((2, audio), (3, speech)):
+                    start = time.perf_counter()
+                    if len(samples):
+                        list(_transcribe(asr_model, samples, language))
+                    row[i] = time.perf_counter() - start
+                line += f"{row[2]:>14.1f}{row[3]:>13.1f}"
+            print(line)
+            totals += row
+        summary = f"{'total':<40}{totals[0]:>11.1f}{100 * totals[1] / max(totals[0], 1e-9):>8.1f}%"
+        if asr_model is not None:
+            summary += f"{totals[2]:>14.1f}{totals[3]:>13.1f}"
+            summary += f"  ({100 * (1 - totals[3] / max(totals[2], 1e-9)):.1f}% ASR time saved)"
+        print(summary)
+    return totals
+
+
+class _ScriptedASR:
+    # stands in for a WhisperModel in the tests, the same words for any audio
+    def __init__(self, words):
+        self.words = words
+        self.calls = 0
+
+    def transcribe(self, audio, language=None, word_timestamps=True, **kwargs):
+        self.calls += 1
+        return iter([SimpleNamespace(words=self.words)]), None
+
+
+def _write_tone(path, seconds, amplitude=0.3, sample_rate=WHISPER_SAMPLE_RATE):
+    t = torch.arange(int(seconds * sample_rate)) / sample_rate
+    torchaudio.save(path, amplitude * torch.sin(2 * torch.pi * 200 * t).unsqueeze(0), sample_rate)
+
+
+def test_segment_sentences():
+    words = [
+        Word(0.5, 0.8, " Hello", 0.9),
+        Word(0.9, 1.2, " there.", 0.9),
+        Word(1.3, 1.6, " How", 0.9),
+        Word(1.7, 2.0, " are", 0.9),
+        Word(2.1, 2.4, ' you?"', 0.9),
+        Word(3.0, 3.2, " and", 0.9),
+    ]
+    sentences = segment_sentences(words, 4.0, buffer=0.2)
+    # clips start `buffer` before their first word or halfway from the previous one, the unfinished last
+    # sentence is dropped
+    assert [text for _, _, text in sentences] == ["Hello there.", 'How are you?"'], sentences
+    assert np.allclose([(start, end) for start, end, _ in sentences], [(0.3, 1.25), (1.25, 2.6)]), sentences
+    assert segment_sentences([Word(0.0, 0.2, " Hi.", 0.9)], 0.3, buffer=0.05) == [], "shorter than min_duration"
+    assert [text for _, _, text in segment_sentences([Word(0, 0.5, " नमस्ते।", 0.9)], 1.0, 0.2)] == ["नमस्ते।"]
+
+    # a sentence longer than max_duration is split at its widest pause, a comma counting as one
+    texts = [f" w{k}" + ("," if k == 4 else "") + ("." if k == 9 else "") for k in range(10)]
+    words = [Word(k + 0.1, k + 0.9, text, 0.9) for k, text in enumerate(texts)]
+    sentences = segment_sentences(words, 10.0, buffer=0.2, max_duration=6)
+    assert [text for _, _, text in sentences] == ["w0 w1 w2 w3 w4,", "w5 w6 w7 w8 w9."], sentences
+    assert all(end - start <= 6 for start, end, _ in sentences), sentences
+
+    # packing merges sentences toward the target, but not across a pause longer than max_gap
+    words = [Word(0, 0.5, " a.", 1), Word(0.6, 1.0, " b.", 1), Word(3.0, 3.5, " c.", 1), Word(3.6, 4.0, " d.", 1)]
+    sentences = segment_sentences(words, 5.0, buffer=0.2, target_duration=10, max_gap=1.0)
+    assert [text for _, _, text in sentences] == ["a. b.", "c. d."], sentences
+
+
+def test_transcribe_group():
+    # a file of 1 s and one of 2 s, 2 s apart once concatenated
+    audios = [("a", np.zeros(WHISPER_SAMPLE_RATE, np.float32)), ("b", np.zeros(2 * WHISPER_SAMPLE_RATE, np.float32))]
+    asr = _ScriptedASR([Word(0.2, 0.5, " One.", 0.9), Word(1.5, 2.0, " Ghost.", 0.9), Word(3.5, 4.25, " Two.", 0.9)])
+    paths, words_per_file = _transcribe_group(asr, audios, "en", gap_seconds=2.0)
+    # each file gets its words in its own time, the word heard in the gap is dropped
+    assert paths == ["a", "b"] and asr.calls == 1
+    assert words_per_file == [[Word(0.2, 0.5, " One.", 0.9)], [Word(0.5, 1.25, " Two.", 0.9)]], words_per_file
+
+
+def test_manifest_reuse():
+    words = [Word(0.2, 0.6, " One", 0.9), Word(0.7, 1.2, " two.", 0.9), Word(2.0, 2.5, " Three.", 0.9)]
+    with tempfile.TemporaryDirectory() as tmp:
+        audio_paths = [os.path.join(tmp, name) for name in ("a.wav", "b.wav")]
+        for audio_path, amplitude in zip(audio_paths, (0.3, 0.2)):
+            _write_tone(audio_path, 3, amplitude)
+        out_path = os.path.join(tmp, "dataset")
+        asr = _ScriptedASR(words)
+        options = {"out_path": out_path, "asr_model": asr, "transcript_cache": None, "eval_percentage": 0}
+
+        def clips():
+            on_disk = sorted(f"wavs/{name}" for name in os.listdir(os.path.join(out_path, "wavs")))
+            listed = sorted(pandas.read_csv(os.path.join(out_path, "metadata_train.csv"), sep="|")["audio_file"])
+            assert on_disk == listed, (on_disk, listed)
+            return listed
+
+        format_audio_list(audio_paths, **options)
+        built = clips()
+        assert len(built) == 4 and asr.calls == 2, built
+        manifest = load_manifest(os.path.join(out_path, MANIFEST_NAME))
+
+        # nothing changed: no file is transcribed or sliced again
+        format_audio_list(audio_paths, **options)
+        assert clips() == built and asr.calls == 2
+        assert load_manifest(os.path.join(out_path, MANIFEST_NAME)) == manifest
+
+        # a changed file replaces its own clips only
+        _write_tone(audio_paths[1], 3, 0.1)
+        format_audio_list(audio_paths, **options)
+        assert clips() == built and asr.calls == 3
+        entries = load_manifest(os.path.join(out_path, MANIFEST_NAME))["files"]
+        old_keys = {entry["source"]: key for key, entry in manifest["files"].items()}
+        assert sorted(entry["source"] for entry in entries.values()) == ["a", "b"], entries
+        assert entries[old_keys["a"]] == manifest["files"][old_keys["a"]]
+        assert old_keys["b"] not in entries
+
+        # b renamed to c and a new b: c keeps the clips it had as b, b gets new ones
+        os.rename(audio_paths[1], os.path.join(tmp, "c.wav"))
+        _write_tone(audio_paths[1], 3, 0.25)
+        audio_paths.append(os.path.join(tmp, "c.wav"))
+        format_audio_list(audio_paths, **options)
+        assert len(clips()) == 6 and asr.calls == 5
+        entries = load_manifest(os.path.join(out_path, MANIFEST_NAME))["files"]
+        assert sorted(entry["source"] for entry in entries.values()) == ["a", "b", "c"], entries
+
+        # a copy of a file is a source of its own
+        shutil.copyfile(audio_paths[0], os.path.join(tmp, "d.wav"))
+        audio_paths.append(os.path.join(tmp, "d.wav"))
+        format_audio_list(audio_paths, **options)
+        assert len(clips()) == 8 and asr.calls == 6
+        entries = load_manifest(os.path.join(out_path, MANIFEST_NAME))["files"]
+        assert sorted(entry["source"] for entry in entries.values()) == ["a", "b", "c", "d"], entries
+
+        # on a fresh build too
+        shutil.rmtree(out_path)
+        format_audio_list(audio_paths, **options)
+        assert len(clips()) == 8 and asr.calls == 10
+
+
+def test_metadata_cleaning_replay():
+    global multilingual_cleaners
+    words = [
+        Word(0.2, 0.5, " It", 0.9),
+        Word(0.6, 0.9, " costs", 0.9),
+        Word(1.0, 1.3, " 5", 0.9),
+        Word(1.4, 1.9, " dollars.", 0.9),
+        Word(2.4, 2.8, " See", 0.9),
+        Word(2.9, 3.4, " you.", 0.9),
+    ]
+    with tempfile.TemporaryDirectory() as tmp:
+        audio_path = os.path.join(tmp, "talk.wav")
+        _write_tone(audio_path, 4)
+        out_path = os.path.join(tmp, "dataset")
+        asr = _ScriptedASR(words)
+        options = {"out_path": out_path, "asr_model": asr, "transcript_cache": None, "eval_percentage": 0}
+        train_path, _, _ = format_audio_list([audio_path], **options)
+        df = pandas.read_csv(train_path, sep="|")
+        assert df["text"].tolist() == ["it costs five dollars.", "see you."], df
+        assert (df["speaker_name"] == "coqui").all(), df
+
+        # a fixed cleaner and a new speaker name apply to the clips already built, without slicing again
+        cleaners = multilingual_cleaners
+        multilingual_cleaners = lambda text, lang: cleaners(text, lang).upper()
+        try:
+            train_path, _, _ = format_audio_list([audio_path], speaker_name="narrator", **options)
+        finally:
+            multilingual_cleaners = cleaners
+        df = pandas.read_csv(train_path, sep="|")
+        assert df["text"].tolist() == ["IT COSTS FIVE DOLLARS.", "SEE YOU."], df
+        assert (df["speaker_name"] == "narrator").all(), df
+        assert asr.calls == 1
+
+
+def test_cached_transcripts():
+    global asr_pool
+    words = [Word(0.2, 0.6, " One", 0.9), Word(0.7, 1.2, " two.", 0.9), Word(2.0, 2.5, " Three.", 0.9)]
+
+    class EvictingCache(TranscriptCache):
+        # another build filling the cache: every other entry is evicted once the first one is read
+        def get(self, key):
+            words = super().get(key)
+            self.prune(max_bytes=0)
+            return words
+
+    with tempfile.TemporaryDirectory() as tmp:
+        audio_paths = [os.path.join(tmp, name) for name in ("a.wav", "b.wav")]
+        for audio_path, amplitude in zip(audio_paths, (0.3, 0.2)):
+            _write_tone(audio_path, 3, amplitude)
+        asr = _ScriptedASR(words)
+        options = {"asr_model": asr, "eval_percentage": 0}
+        cache = TranscriptCache(os.path.join(tmp, "cache"))
+        format_audio_list(audio_paths, out_path=os.path.join(tmp, "first"), transcript_cache=cache, **options)
+        assert asr.calls == 2 and len(cache.entries()) == 2
+
+        # Whisper is borrowed from the pool only when a transcript is missing when the files are looked up
+        borrowed = []
+
+        def model(whisper_model, **asr_options):
+            borrowed.append(whisper_model)
+            return nullcontext(asr)
+
+        pool, asr_pool = asr_pool, SimpleNamespace(model=model)
+        try:
+            options["asr_model"] = None
+            format_audio_list(audio_paths, out_path=os.path.join(tmp, "cached"), transcript_cache=cache, **options)
+            assert asr.calls == 2 and not borrowed and cache.hits == 2
+
+            cache = EvictingCache(cache.cache_dir)
+            train_path, _, _ = format_audio_list(
+                audio_paths, out_path=os.path.join(tmp, "evicted"), transcript_cache=cache, **options
+            )
+        finally:
+            asr_pool = pool
+        assert asr.calls == 3 and borrowed == ["large-v2"] and cache.hits == 1
+        assert len(pandas.read_csv(train_path, sep="|")) == 4
+
+
+def test_quality_filter():
+    words = [Word(0.2, 0.6, " One", 0.9), Word(0.7, 1.2, " two.", 0.9), Word(2.0, 2.5, " Three.", 0.9)]
+    with tempfile.TemporaryDirectory() as tmp:
+        # b is clipped
+        audio_paths = [os.path.join(tmp, name) for name in ("a.wav", "b.wav")]
+        for audio_path, amplitude in zip(audio_paths, (0.3, 1.0)):
+            _write_tone(audio_path, 3, amplitude)
+        out_path = os.path.join(tmp, "dataset")
+        asr = _ScriptedASR(words)
+        options = {"out_path": out_path, "asr_model": asr, "transcript_cache": None, "eval_percentage": 0}
+
+        # by default every clip is kept and no report is written
+        clips = [f"wavs/{name}_{k:08d}.wav" for name in "ab" for k in range(2)]
+        train_path, _, _ = format_audio_list(audio_paths, **options)
+        df = pandas.read_csv(train_path, sep="|")
+        assert sorted(df["audio_file"]) == clips, df
+        assert not os.path.exists(os.path.join(out_path, "quality_report.csv"))
+
+        # a steady tone has no noise floor to measure an SNR against
+        train_path, _, _ = format_audio_list(audio_paths, quality=ClipQuality(min_snr_db=-100), **options)
+        assert sorted(pandas.read_csv(train_path, sep="|")["audio_file"]) == clips[:2]
+        report = pandas.read_csv(os.path.join(out_path, "quality_report.csv"), sep="|", keep_default_na=False)
+        assert sorted(report["dropped"]) == ["", "", "clipped", "clipped"], report
+        assert asr.calls == 2
+
+        # back to the default, the clips dropped before are written again
+        train_path, _, _ = format_audio_list(audio_paths, **options)
+        assert pandas.read_csv(train_path, sep="|").equals(df)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Dataset formatter tools")
+    parser.add_argument("--benchmark_decoding", nargs="+", metavar="AUDIO", help="Compare decode time per file")
+    parser.add_argument("--benchmark_vad", nargs="+", metavar="AUDIO", help="Report the audio trimmed as silence")
+    parser.add_argument(
+        "--benchmark_loading", nargs="+", metavar="CSV", help="Time loading the clips of metadata csvs like the trainer"
+    )
+    parser.add_argument("--whisper_model", type=str, default=None, help="--benchmark_vad: also time the ASR")
+    parser.add_argument("--language", type=str, default=None, help="--benchmark_vad: language of the audio")
+    args = parser.parse_args()
+
+    if args.benchmark_decoding:
+        benchmark_decoding(args.benchmark_decoding)
+    if args.benchmark_vad:
+        benchmark_vad(args.benchmark_vad, args.whisper_model, args.language)
+    if args.benchmark_loading:
+        benchmark_clip_loading(args.benchmark_loading)
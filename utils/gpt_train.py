@@ -5,12 +5,25 @@ from trainer import Trainer, TrainerArgs
 
 from TTS.config.shared_configs import BaseDatasetConfig
 from TTS.tts.datasets import load_tts_samples
+from TTS.tts.layers.xtts.tokenizer import VoiceBpeTokenizer
 from TTS.tts.layers.xtts.trainer.gpt_trainer import GPTArgs, GPTTrainer, GPTTrainerConfig
 from TTS.tts.models.xtts import XttsAudioConfig
 from TTS.utils.manage import ModelManager
-
-
-def train_gpt(language, num_epochs, batch_size, grad_acumm, train_csv, eval_csv, output_path, max_audio_length=255995):
+from utils.lengths import filter_by_length, read_lengths
+from utils.packed_dataset import PACKED_PREFIX, PackedDataset, export_clip, install_loader, is_packed
+
+
+def train_gpt(
+    language,
+    num_epochs,
+    batch_size,
+    grad_acumm,
+    train_csv,
+    eval_csv,
+    output_path,
+    max_audio_length=255995,
+    max_text_length=200,
+):
     #  Logging parameters
     RUN_NAME = "GPT_XTTS_FT"
     PROJECT_NAME = "XTTS_trainer"
@@ -81,7 +94,7 @@ def train_gpt(language, num_epochs, batch_size, grad_acumm, train_csv, eval_csv,
         min_conditioning_length=66150,  # 3 secs
         debug_loading_failures=False,
         max_wav_length=max_audio_length,  # ~11.6 seconds
-        max_text_length=200,
+        max_text_length=max_text_length,
         mel_norm_file=MEL_NORM_FILE,
         dvae_checkpoint=DVAE_CHECKPOINT,
         xtts_checkpoint=XTTS_CHECKPOINT,  # checkpoint path of the model that you want to fine-tune
@@ -135,11 +148,31 @@ def train_gpt(language, num_epochs, batch_size, grad_acumm, train_csv, eval_csv,
     model = GPTTrainer.init_from_config(config)
 
     # load training samples
-    train_samples, eval_samples = load_tts_samples(
-        DATASETS_CONFIG_LIST,
-        eval_split=True,
-        eval_split_max_size=config.eval_split_max_size,
-        eval_split_size=config.eval_split_size,
+    if is_packed(train_csv):
+        # packed datasets (see utils.packed_dataset) are read from their shards
+        install_loader()
+        train_samples = PackedDataset(train_csv).samples(language)
+        eval_samples = PackedDataset(eval_csv).samples(language)
+    else:
+        train_samples, eval_samples = load_tts_samples(
+            DATASETS_CONFIG_LIST,
+            eval_split=True,
+            eval_split_max_size=config.eval_split_max_size,
+            eval_split_size=config.eval_split_size,
+        )
+        # the coqui formatter drops the length columns of the metadata
+        for samples, metadata_path in ((train_samples, train_csv), (eval_samples, eval_csv)):
+            lengths = read_lengths(metadata_path)
+            for sample in samples:
+                sample.update(lengths.get(sample["audio_file"], {}))
+
+    # drop the clips the trainer would skip after loading them, metadata without token counts is tokenized here
+    tokenizer = VoiceBpeTokenizer(TOKENIZER_FILE)
+    train_samples = filter_by_length(
+        train_samples, max_audio_length, max_text_length, tokenizer, language, name="train samples"
+    )
+    eval_samples = filter_by_length(
+        eval_samples, max_audio_length, max_text_length, tokenizer, language, name="eval samples"
     )
 
     # init the trainer and 🚀
@@ -162,6 +195,8 @@ def train_gpt(language, num_epochs, batch_size, grad_acumm, train_csv, eval_csv,
     samples_len = [len(item["text"].split(" ")) for item in train_samples]
     longest_text_idx = samples_len.index(max(samples_len))
     speaker_ref = train_samples[longest_text_idx]["audio_file"]
+    if speaker_ref.startswith(PACKED_PREFIX):
+        speaker_ref = export_clip(speaker_ref, os.path.join(OUT_PATH, "speaker_reference.wav"))
 
     trainer_out_path = trainer.output_path
 
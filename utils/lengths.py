@@ -0,0 +1,67 @@
+"""Clip and text lengths as the XTTS trainer measures them, so clips it would skip are dropped before it
+loads any. Imported by the trainer, keep it free of the ASR dependencies."""
+import os
+
+import pandas
+
+# XTTS trains on 22050 Hz audio: the trainer skips clips shorter than half a second, and longer than
+# train_gpt's max_audio_length (255995 samples by default)
+XTTS_SAMPLE_RATE = 22050
+MIN_CLIP_DURATION = 0.5
+MAX_CLIP_DURATION = 255995 / XTTS_SAMPLE_RATE
+
+LENGTH_COLUMNS = ["audio_file", "wav_length", "text_length"]
+
+
+def wav_length(num_samples, sample_rate):
+    """Length in samples of a clip once the trainer loads it at XTTS_SAMPLE_RATE, what max_wav_length limits"""
+    # the length torchaudio's resampling gives
+    return -(-num_samples * XTTS_SAMPLE_RATE // sample_rate)
+
+
+def read_lengths(metadata_path):
+    """`{audio path: {"wav_length", "text_length"}}` of a metadata csv, the paths joined to the csv folder as
+    the coqui formatter does, empty for metadata without the lengths"""
+    df = pandas.read_csv(metadata_path, sep="|", usecols=lambda column: column in LENGTH_COLUMNS)
+    if "wav_length" not in df or "text_length" not in df:
+        return {}
+    root = os.path.dirname(metadata_path)
+    return {
+        os.path.join(root, audio_file): {"wav_length": int(wav_len), "text_length": int(text_len)}
+        for audio_file, wav_len, text_len in zip(df["audio_file"], df["wav_length"], df["text_length"])
+    }
+
+
+def filter_by_length(samples, max_wav_length, max_text_length, tokenizer=None, language=None, name="samples"):
+    """The samples the XTTS trainer can use, before it loads a single clip.
+
+    The trainer skips clips shorter than MIN_CLIP_DURATION or longer than `max_wav_length` samples and
+    texts longer than `max_text_length` tokens, but only once it has loaded them, every epoch. Samples with
+    "wav_length" and "text_length" keys (see read_lengths) are checked here instead, missing text lengths
+    are computed with the XTTS `tokenizer` in `language` when given, samples with unknown lengths are kept.
+    """
+    if tokenizer is not None:
+        for sample in samples:
+            if sample.get("text_length", -1) < 0:
+                sample["text_length"] = len(tokenizer.encode(sample["text"], language))
+
+    min_wav_length = MIN_CLIP_DURATION * XTTS_SAMPLE_RATE
+    kept = []
+    too_short = too_long = too_many_tokens = 0
+    for sample in samples:
+        wav_len = sample.get("wav_length", -1)
+        if 0 <= wav_len < min_wav_length:
+            too_short += 1
+        elif wav_len > max_wav_length:
+            too_long += 1
+        elif sample.get("text_length", -1) > max_text_length:
+            too_many_tokens += 1
+        else:
+            kept.append(sample)
+    if len(kept) < len(samples):
+        print(
+            f"Dropped {len(samples) - len(kept)} of {len(samples)} {name}: {too_short} shorter than "
+            f"{MIN_CLIP_DURATION}s, {too_long} over {max_wav_length} samples, {too_many_tokens} over "
+            f"{max_text_length} tokens"
+        )
+    return kept
@@ -0,0 +1,165 @@
+"""Normalize a metadata csv or a text corpus with multilingual_cleaners in a process pool.
+
+Example, re-cleaning a dataset after a cleaner fix:
+
+    python -m utils.normalize_corpus dataset/metadata_train.csv metadata_train.clean.csv --lang hi
+"""
+import argparse
+import csv
+import itertools
+import os
+import time
+from multiprocessing import Pool
+
+from utils.tokenizer import VoiceBpeTokenizer, multilingual_cleaners
+
+_clean = None
+
+
+def _init_worker(lang, transliterate):
+    global _clean
+    if transliterate:
+        tokenizer = VoiceBpeTokenizer()
+        _clean = lambda text: tokenizer.preprocess_text(text, lang)
+    else:
+        _clean = lambda text: multilingual_cleaners(text, lang)
+
+
+def _clean_row(job):
+    row, text_idx = job
+    if text_idx is None:
+        return _clean(row) if row.strip() else row
+    row[text_idx] = _clean(row[text_idx])
+    return row
+
+
+def _batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def normalize_corpus(
+    input_path,
+    output_path,
+    lang,
+    input_format="metadata",
+    num_workers=None,
+    chunk_size=256,
+    text_column="text",
+    transliterate=False,
+):
+    """Clean every text of `input_path` and write the result, in the input order, to `output_path`.
+
+    `input_format` is "metadata" for a pipe delimited csv with a header (like metadata_train.csv), where only
+    `text_column` is cleaned, or "text" for one text per line. Rows are streamed in batches so at most two
+    batches are in memory, one being cleaned by the pool and one being written. Returns the number of lines.
+    """
+    num_workers = num_workers or os.cpu_count()
+    batch_size = chunk_size * num_workers * 4
+    n_lines = 0
+
+    with open(input_path, "r", encoding="utf-8", newline="") as fin, open(
+        output_path, "w", encoding="utf-8", newline=""
+    ) as fout:
+        if input_format == "metadata":
+            reader = csv.reader(fin, delimiter="|")
+            writer = csv.writer(fout, delimiter="|", lineterminator="\n")
+            header = next(reader)
+            writer.writerow(header)
+            text_idx = header.index(text_column)
+            jobs = ((row, text_idx) for row in reader)
+            write = writer.writerows
+        elif input_format == "text":
+            jobs = ((line.rstrip("\n"), None) for line in fin)
+            write = lambda lines: fout.writelines(line + "\n" for line in lines)
+        else:
+            raise ValueError(f"Unknown input format '{input_format}', expected 'metadata' or 'text'")
+
+        if num_workers == 1:
+            _init_worker(lang, transliterate)
+            for batch in _batched(jobs, batch_size):
+                write([_clean_row(job) for job in batch])
+                n_lines += len(batch)
+            return n_lines
+
+        with Pool(num_workers, initializer=_init_worker, initargs=(lang, transliterate)) as pool:
+            pending = None
+            for batch in _batched(jobs, batch_size):
+                # clean the next batch while the previous one is written
+                result = pool.map_async(_clean_row, batch, chunksize=chunk_size)
+                if pending is not None:
+                    write(pending.get())
+                pending = result
+                n_lines += len(batch)
+            if pending is not None:
+                write(pending.get())
+    return n_lines
+
+
+def report_scaling(input_path, lang, input_format="metadata", max_workers=None, chunk_size=256, transliterate=False):
+    """Print lines/sec for 1, 2, 4, ... up to `max_workers` processes"""
+    max_workers = max_workers or os.cpu_count()
+    workers = [1]
+    while workers[-1] * 2 < max_workers:
+        workers.append(workers[-1] * 2)
+    if workers[-1] != max_workers:
+        workers.append(max_workers)
+
+    print(f"{'workers':>8}{'lines/sec':>14}{'speedup':>10}")
+    results = []
+    for num_workers in workers:
+        start = time.perf_counter()
+        n_lines = normalize_corpus(
+            input_path,
+            os.devnull,
+            lang,
+            input_format=input_format,
+            num_workers=num_workers,
+            chunk_size=chunk_size,
+            transliterate=transliterate,
+        )
+        lines_per_sec = n_lines / (time.perf_counter() - start)
+        results.append((num_workers, lines_per_sec))
+        print(f"{num_workers:>8}{lines_per_sec:>14.1f}{lines_per_sec / results[0][1]:>10.2f}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Normalize a metadata csv or text corpus with multilingual_cleaners")
+    parser.add_argument("input", type=str, help="Pipe delimited metadata csv, or a text file with one text per line")
+    parser.add_argument("output", type=str, nargs="?", help="Where to write the normalized file")
+    parser.add_argument("--lang", type=str, required=True, help="Language of the texts")
+    parser.add_argument("--format", type=str, choices=["metadata", "text"], default="metadata", help="Default: metadata")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes. Default: all cores")
+    parser.add_argument("--chunk_size", type=int, default=256, help="Lines per task sent to a worker. Default: 256")
+    parser.add_argument("--text_column", type=str, default="text", help="Metadata column to clean. Default: text")
+    parser.add_argument(
+        "--transliterate",
+        action="store_true",
+        help="Use VoiceBpeTokenizer.preprocess_text, which also romanizes zh and ko, instead of multilingual_cleaners",
+    )
+    parser.add_argument("--scaling", action="store_true", help="Report lines/sec from 1 to --workers processes")
+    args = parser.parse_args()
+
+    if args.scaling:
+        report_scaling(args.input, args.lang, args.format, args.workers, args.chunk_size, args.transliterate)
+    else:
+        if not args.output:
+            parser.error("output is required unless --scaling is given")
+        start = time.perf_counter()
+        n_lines = normalize_corpus(
+            args.input,
+            args.output,
+            args.lang,
+            input_format=args.format,
+            num_workers=args.workers,
+            chunk_size=args.chunk_size,
+            text_column=args.text_column,
+            transliterate=args.transliterate,
+        )
+        elapsed = time.perf_counter() - start
+        print(f"Normalized {n_lines} lines in {elapsed:.1f}s ({n_lines / elapsed:.1f} lines/sec)")
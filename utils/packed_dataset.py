@@ -0,0 +1,327 @@
+"""Packed datasets: clips stored back to back in a few large PCM shards instead of one wav per clip.
+
+A packed dataset is a directory with
+
+    info.json         sample rate, sample type and shard names
+    index.npy         (shard, offset, length) per clip, in samples, memory mapped when read
+    metadata.csv      audio_file|text|speaker_name, and the other metadata columns, per clip in index order
+    shard_00000.pcm   mono little endian 16 bit PCM
+
+Convert from and to the metadata csv + wavs/ layout written by the formatter with:
+
+    python -m utils.packed_dataset pack dataset/metadata_train.csv dataset/packed_train
+    python -m utils.packed_dataset unpack dataset/packed_train dataset_copy --csv_name metadata_train.csv
+"""
+import argparse
+import csv
+import json
+import os
+import tempfile
+
+import numpy as np
+import torch
+import torchaudio
+
+PACKED_VERSION = 1
+PACKED_PREFIX = "packed://"
+INDEX_DTYPE = np.dtype([("shard", "<u4"), ("offset", "<u8"), ("length", "<u8")])
+
+_resamplers = {}
+
+
+def resampler(orig_freq, new_freq):
+    """A torchaudio Resample transform, built once per rate pair, building the kernel is costly"""
+    key = (orig_freq, new_freq)
+    if key not in _resamplers:
+        _resamplers[key] = torchaudio.transforms.Resample(orig_freq, new_freq)
+    return _resamplers[key]
+
+
+def is_packed(path):
+    return os.path.isfile(os.path.join(path, "info.json")) and os.path.isfile(os.path.join(path, "index.npy"))
+
+
+class PackedWriter:
+    """Appends clips to shards of about `shard_mb` megabytes, the index is written by close().
+
+    `columns` are the metadata columns of the rows given to add(), audio_file, text and speaker_name first.
+    """
+
+    def __init__(self, path, sample_rate, shard_mb=1024, columns=("audio_file", "text", "speaker_name")):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.columns = list(columns)
+        self.shard_samples = int(shard_mb * 1024**2) // 2
+        self.shards = []
+        self._index = []
+        self._rows = []
+        self._file = None
+        self._offset = 0
+        os.makedirs(path, exist_ok=True)
+        # repacking, the old dataset is invalid until close() and its shards are replaced
+        for name in os.listdir(path):
+            if name == "info.json" or (name.startswith("shard_") and name.endswith(".pcm")):
+                os.remove(os.path.join(path, name))
+
+    def __len__(self):
+        return len(self._index)
+
+    def _next_shard(self):
+        if self._file is not None:
+            self._file.close()
+        self.shards.append(f"shard_{len(self.shards):05d}.pcm")
+        self._file = open(os.path.join(self.path, self.shards[-1]), "wb")
+        self._offset = 0
+
+    def add(self, audio, *row):
+        """Append a mono float clip in [-1, 1] at the writer's sample rate, `row` is its metadata"""
+        audio = audio.numpy() if isinstance(audio, torch.Tensor) else np.asarray(audio)
+        # the scale audio() and torchaudio.load use, so PCM16 clips are stored sample exact
+        pcm = np.clip(np.round(audio.reshape(-1) * 32768), -32768, 32767).astype("<i2")
+        if self._file is None or (self._offset and self._offset + len(pcm) > self.shard_samples):
+            self._next_shard()
+        self._file.write(pcm.tobytes())
+        self._index.append((len(self.shards) - 1, self._offset, len(pcm)))
+        self._rows.append(row)
+        self._offset += len(pcm)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        np.save(os.path.join(self.path, "index.npy"), np.array(self._index, dtype=INDEX_DTYPE))
+        with open(os.path.join(self.path, "metadata.csv"), "w", encoding="utf-8", newline="") as f:
+            writer = csv.writer(f, delimiter="|", lineterminator="\n")
+            writer.writerow(self.columns)
+            writer.writerows(self._rows)
+        # info.json last, a packed dataset is only valid once it exists
+        with open(os.path.join(self.path, "info.json"), "w", encoding="utf-8") as f:
+            json.dump(
+                {"version": PACKED_VERSION, "sample_rate": self.sample_rate, "dtype": "<i2", "shards": self.shards}, f
+            )
+
+
+class PackedDataset:
+    """Read access to a packed dataset, clips are zero copy views of the memory mapped shards"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "info.json"), "r", encoding="utf-8") as f:
+            info = json.load(f)
+        if info["version"] != PACKED_VERSION:
+            raise ValueError(f"{path} is packed with version {info['version']}, expected {PACKED_VERSION}")
+        self.sample_rate = info["sample_rate"]
+        self._dtype = np.dtype(info["dtype"])
+        self._shard_names = info["shards"]
+        self._shards = [None] * len(self._shard_names)
+        self.index = np.load(os.path.join(path, "index.npy"), mmap_mode="r")
+        with open(os.path.join(path, "metadata.csv"), "r", encoding="utf-8", newline="") as f:
+            reader = csv.reader(f, delimiter="|")
+            self.columns = next(reader)
+            self.rows = list(reader)
+
+    def __len__(self):
+        return len(self.index)
+
+    def _shard(self, shard):
+        if self._shards[shard] is None:
+            self._shards[shard] = np.memmap(
+                os.path.join(self.path, self._shard_names[shard]), dtype=self._dtype, mode="r"
+            )
+        return self._shards[shard]
+
+    def pcm(self, i):
+        """The PCM samples of clip `i`, a view of the shard"""
+        shard, offset, length = self.index[i]
+        return self._shard(shard)[offset : offset + length]
+
+    def audio(self, i):
+        """Clip `i` as a float tensor of shape (1, samples)"""
+        return torch.from_numpy(self.pcm(i).astype(np.float32) / 32768).unsqueeze(0)
+
+    def samples(self, language, dataset_name="ft_dataset"):
+        """Samples in the format of load_tts_samples, audio_file being a packed reference for load_audio.
+        The wav_length and text_length metadata columns, when there, are kept as ints for
+        utils.lengths.filter_by_length."""
+        root_path = os.path.abspath(self.path)
+        lengths = [name for name in ("wav_length", "text_length") if name in self.columns]
+        samples = []
+        for i, row in enumerate(self.rows):
+            values = dict(zip(self.columns, row))
+            sample = {
+                "text": values["text"],
+                "audio_file": f"{PACKED_PREFIX}{root_path}?{i}",
+                "speaker_name": values["speaker_name"],
+                "root_path": root_path,
+                "language": language,
+                "audio_unique_name": f"{dataset_name}#{values['audio_file']}",
+            }
+            sample.update((name, int(values[name])) for name in lengths)
+            samples.append(sample)
+        return samples
+
+
+_open_datasets = {}
+
+
+def _resolve(reference):
+    path, i = reference[len(PACKED_PREFIX) :].rsplit("?", 1)
+    if path not in _open_datasets:
+        _open_datasets[path] = PackedDataset(path)
+    return _open_datasets[path], int(i)
+
+
+def load_audio(audiopath, sampling_rate):
+    """The trainer's load_audio, which also reads packed references"""
+    if not audiopath.startswith(PACKED_PREFIX):
+        return _trainer_load_audio(audiopath, sampling_rate)
+    dataset, i = _resolve(audiopath)
+    audio = dataset.audio(i)
+    if dataset.sample_rate != sampling_rate:
+        audio = resampler(dataset.sample_rate, sampling_rate)(audio)
+    return audio.clip_(-1, 1)
+
+
+def _trainer_load_audio(audiopath, sampling_rate):
+    from TTS.tts.models.xtts import load_audio as xtts_load_audio
+
+    return xtts_load_audio(audiopath, sampling_rate)
+
+
+def install_loader():
+    """Make the XTTS trainer dataset read packed references"""
+    from TTS.tts.layers.xtts.trainer import dataset
+
+    dataset.load_audio = load_audio
+
+
+def export_clip(reference, out_path):
+    """Write a packed clip to a wav file, returns `out_path`"""
+    dataset, i = _resolve(reference)
+    torchaudio.save(out_path, dataset.audio(i), dataset.sample_rate, encoding="PCM_S", bits_per_sample=16)
+    return out_path
+
+
+def pack(metadata_path, out_path, sample_rate=22050, shard_mb=1024):
+    """Pack the clips of a pipe delimited metadata csv, paths relative to the csv folder, every column is
+    kept. Returns the number of clips."""
+    root = os.path.dirname(metadata_path)
+    with open(metadata_path, "r", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f, delimiter="|")
+        header = next(reader)
+        audio_column = header.index("audio_file")
+        writer = PackedWriter(out_path, sample_rate, shard_mb, columns=header)
+        for row in reader:
+            wav, sr = torchaudio.load(os.path.join(root, row[audio_column]))
+            wav = wav.mean(dim=0)
+            if sr != sample_rate:
+                wav = resampler(sr, sample_rate)(wav)
+            writer.add(wav, *row)
+    writer.close()
+    return len(writer)
+
+
+def unpack(packed_path, out_path, csv_name="metadata.csv"):
+    """Write a packed dataset back as wavs under `out_path` and `csv_name`, returns the csv path"""
+    dataset = PackedDataset(packed_path)
+    audio_column = dataset.columns.index("audio_file")
+    for i, row in enumerate(dataset.rows):
+        clip_path = os.path.join(out_path, row[audio_column])
+        os.makedirs(os.path.dirname(clip_path), exist_ok=True)
+        torchaudio.save(clip_path, dataset.audio(i), dataset.sample_rate, encoding="PCM_S", bits_per_sample=16)
+    metadata_path = os.path.join(out_path, csv_name)
+    with open(metadata_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="|", lineterminator="\n")
+        writer.writerow(dataset.columns)
+        writer.writerows(dataset.rows)
+    return metadata_path
+
+
+def _write_clips(root, lengths, sample_rate):
+    """PCM16 wavs of random samples, full scale included, and their metadata.csv, returns the samples"""
+    rng = np.random.default_rng(0)
+    os.makedirs(os.path.join(root, "wavs"))
+    clips = []
+    with open(os.path.join(root, "metadata.csv"), "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="|", lineterminator="\n")
+        writer.writerow(["audio_file", "text", "speaker_name", "wav_length"])
+        for i, length in enumerate(lengths):
+            pcm = rng.integers(-32768, 32768, length).astype(np.int16)
+            pcm[:2] = (-32768, 32767)
+            audio_file = f"wavs/clip_{i}.wav"
+            torchaudio.save(
+                os.path.join(root, audio_file),
+                torch.from_numpy(pcm.astype(np.float32) / 32768).unsqueeze(0),
+                sample_rate,
+                encoding="PCM_S",
+                bits_per_sample=16,
+            )
+            writer.writerow([audio_file, f"Clip {i}.", "coqui", length])
+            clips.append(pcm)
+    return clips
+
+
+def test_pack_roundtrip():
+    lengths = [3000, 1000, 5000, 2000]
+    with tempfile.TemporaryDirectory() as tmp:
+        clips = _write_clips(os.path.join(tmp, "dataset"), lengths, 22050)
+        metadata_path = os.path.join(tmp, "dataset", "metadata.csv")
+        # 8000 samples per shard, the third clip starts a new one
+        assert pack(metadata_path, os.path.join(tmp, "packed"), 22050, shard_mb=16000 / 1024**2) == len(clips)
+
+        dataset = PackedDataset(os.path.join(tmp, "packed"))
+        assert dataset._shard_names == ["shard_00000.pcm", "shard_00001.pcm"]
+        assert dataset.index.tolist() == [(0, 0, 3000), (0, 3000, 1000), (1, 0, 5000), (1, 5000, 2000)]
+        for i, pcm in enumerate(clips):
+            assert np.array_equal(dataset.pcm(i), pcm)
+
+        metadata_copy = unpack(os.path.join(tmp, "packed"), os.path.join(tmp, "copy"), "metadata_train.csv")
+        with open(metadata_path, "r", encoding="utf-8") as f:
+            metadata = f.read()
+        with open(metadata_copy, "r", encoding="utf-8") as f:
+            assert f.read() == metadata
+        for i, pcm in enumerate(clips):
+            wav, sr = torchaudio.load(os.path.join(tmp, "copy", "wavs", f"clip_{i}.wav"))
+            assert sr == 22050
+            assert np.array_equal((wav[0] * 32768).numpy().astype(np.int16), pcm)
+
+
+def test_load_audio():
+    with tempfile.TemporaryDirectory() as tmp:
+        _write_clips(os.path.join(tmp, "dataset"), [4000, 2500], 24000)
+        pack(os.path.join(tmp, "dataset", "metadata.csv"), os.path.join(tmp, "packed"), 24000)
+        samples = PackedDataset(os.path.join(tmp, "packed")).samples("en")
+        assert [sample["wav_length"] for sample in samples] == [4000, 2500]
+
+        install_loader()
+        from TTS.tts.layers.xtts.trainer import dataset
+
+        assert dataset.load_audio is load_audio
+        for i, sample in enumerate(samples):
+            wav_path = os.path.join(tmp, "dataset", "wavs", f"clip_{i}.wav")
+            assert torch.equal(load_audio(sample["audio_file"], 24000), _trainer_load_audio(wav_path, 24000))
+            # resampled by the trainer's rate, up to the float error of the two resampling implementations
+            resampled = _trainer_load_audio(wav_path, 22050)
+            assert torch.allclose(load_audio(sample["audio_file"], 22050), resampled, atol=1e-5)
+            # a wav path goes to the trainer's loader
+            assert torch.equal(load_audio(wav_path, 22050), _trainer_load_audio(wav_path, 22050))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert between metadata csv + wavs/ and packed datasets")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="Pack the clips of a metadata csv")
+    pack_parser.add_argument("metadata", type=str)
+    pack_parser.add_argument("output", type=str)
+    pack_parser.add_argument("--sample_rate", type=int, default=22050, help="Default: 22050, what XTTS trains on")
+    pack_parser.add_argument("--shard_mb", type=float, default=1024, help="Shard size. Default: 1024")
+    unpack_parser = subparsers.add_parser("unpack", help="Write a packed dataset back as a metadata csv + wavs/")
+    unpack_parser.add_argument("packed", type=str)
+    unpack_parser.add_argument("output", type=str)
+    unpack_parser.add_argument("--csv_name", type=str, default="metadata.csv", help="Default: metadata.csv")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        n_clips = pack(args.metadata, args.output, args.sample_rate, args.shard_mb)
+        print(f"Packed {n_clips} clips into {args.output}")
+    else:
+        print(f"Unpacked to {unpack(args.packed, args.output, args.csv_name)}")
@@ -0,0 +1,251 @@
+"""On disk cache of word level Whisper output, so datasets can be re-segmented without running the ASR again.
+
+Inspect or prune it with:
+
+    python -m utils.transcript_cache inspect --list
+    python -m utils.transcript_cache prune --max_size_mb 500
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+# word level ASR output, times in seconds from the start of the file
+Word = namedtuple("Word", ["start", "end", "word", "probability"])
+
+
+def default_cache_dir():
+    return os.environ.get(
+        "XTTS_TRANSCRIPT_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "xtts_finetune", "transcripts")
+    )
+
+
+def _encode_words(words, meta):
+    # one array per field, the word texts as a single utf-8 buffer plus offsets
+    texts = [word.word.encode("utf-8") for word in words]
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(text) for text in texts])
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        start=np.array([word.start for word in words], dtype=np.float64),
+        end=np.array([word.end for word in words], dtype=np.float64),
+        probability=np.array([word.probability for word in words], dtype=np.float16),
+        text=np.frombuffer(b"".join(texts), dtype=np.uint8),
+        offsets=offsets,
+        meta=np.array(json.dumps(meta)),
+    )
+    return buffer.getvalue()
+
+
+def _decode_words(data):
+    text = data["text"].tobytes()
+    offsets = data["offsets"]
+    return [
+        Word(float(start), float(end), text[offsets[i] : offsets[i + 1]].decode("utf-8"), float(probability))
+        for i, (start, end, probability) in enumerate(zip(data["start"], data["end"], data["probability"]))
+    ]
+
+
+class TranscriptCache:
+    """Word level transcripts stored as one compressed npz per (audio hash, ASR settings).
+
+    The cache is kept under `max_bytes` by removing the least recently used entries, a hit refreshes the
+    entry's modification time, which is what the eviction order is based on.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=1024**3):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._total_bytes = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(audio_hash, model, language, **settings):
+        """Entry key of the transcript of the audio with content hash `audio_hash`"""
+        settings.update(audio_hash=audio_hash, model=model, language=language)
+        return hashlib.sha256(json.dumps(settings, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npz")
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    def get(self, key):
+        """The cached words of `key`, None on a miss"""
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                words = _decode_words(data)
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return words
+
+    def put(self, key, words, **meta):
+        """Store `words` under `key`, `meta` is kept for inspection"""
+        if self.max_bytes <= 0:
+            return
+        meta.update(created=time.time(), n_words=len(words))
+        data = _encode_words(words, meta)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, readers never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.isfile(path) else 0
+            os.replace(tmp_path, path)
+            if self._total_bytes is not None:
+                self._total_bytes += len(data) - old_size
+            if self._size() > self.max_bytes:
+                self._prune(self.max_bytes)
+
+    def entries(self):
+        """`(key, size in bytes, last used time)` of every entry, least recently used first"""
+        entries = []
+        if not os.path.isdir(self.cache_dir):
+            return entries
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".npz"):
+                    stat = entry.stat()
+                    entries.append((entry.name[: -len(".npz")], stat.st_size, stat.st_mtime))
+        return sorted(entries, key=lambda entry: entry[2])
+
+    def meta(self, key):
+        with np.load(self._path(key)) as data:
+            return json.loads(str(data["meta"]))
+
+    def _size(self):
+        if self._total_bytes is None:
+            self._total_bytes = sum(size for _, size, _ in self.entries())
+        return self._total_bytes
+
+    def _prune(self, max_bytes, older_than=None):
+        removed = []
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        now = time.time()
+        for key, size, last_used in entries:
+            if total <= max_bytes and (older_than is None or now - last_used < older_than):
+                continue
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed.append(key)
+        self._total_bytes = total
+        return removed
+
+    def prune(self, max_bytes=None, older_than=None):
+        """Remove least recently used entries until the cache fits `max_bytes` (default: the cap), and every
+        entry unused for `older_than` seconds. Returns the removed keys."""
+        with self._lock:
+            return self._prune(self.max_bytes if max_bytes is None else max_bytes, older_than)
+
+    def clear(self):
+        return self.prune(max_bytes=0)
+
+
+transcript_cache = TranscriptCache()
+
+
+def _format_size(n_bytes):
+    return f"{n_bytes / 1024**2:.1f} MB"
+
+
+def _age(cache, key, seconds):
+    # last used `seconds` ago
+    last_used = time.time() - seconds
+    os.utime(cache._path(key), (last_used, last_used))
+
+
+def test_lru_eviction():
+    words = [Word(0.1 * k, 0.1 * k + 0.05, f" w{k}", 0.5) for k in range(50)]
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = TranscriptCache(tmp)
+        keys = [TranscriptCache.key(name, "large-v2", "en") for name in ("a", "b", "c")]
+        cache.put(keys[0], words)
+        entry_size = cache.entries()[0][1]
+        cache.max_bytes = int(2.5 * entry_size)
+        cache.put(keys[1], words)
+        _age(cache, keys[0], 300)
+        _age(cache, keys[1], 200)
+        # a hit makes a the most recently used, b goes first
+        assert cache.get(keys[0]) == words and cache.hits == 1
+        cache.put(keys[2], words)
+        assert keys[0] in cache and keys[1] not in cache and keys[2] in cache
+        assert cache.get(keys[1]) is None and cache.misses == 1
+        assert cache._size() == sum(size for _, size, _ in cache.entries()) <= cache.max_bytes
+
+        # a disabled cache stores nothing
+        disabled = TranscriptCache(os.path.join(tmp, "disabled"), max_bytes=0)
+        disabled.put(keys[0], words)
+        assert disabled.entries() == [] and disabled.get(keys[0]) is None
+
+
+def test_prune():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = TranscriptCache(tmp)
+        keys = [TranscriptCache.key(str(k), "large-v2", "en") for k in range(4)]
+        for age, key in zip((400, 300, 200, 100), keys):
+            cache.put(key, [Word(0.0, 0.5, " Hi.", 0.9)], model="large-v2")
+            _age(cache, key, age)
+        assert [key for key, _, _ in cache.entries()] == keys
+        assert cache.meta(keys[0])["model"] == "large-v2"
+
+        assert cache.prune(older_than=250) == keys[:2]
+        # down to one entry, the least recently used goes
+        assert cache.prune(max_bytes=max(size for _, size, _ in cache.entries())) == keys[2:3]
+        assert [key for key, _, _ in cache.entries()] == keys[3:]
+        assert cache._size() == cache.entries()[0][1]
+        assert cache.clear() == keys[3:] and cache.entries() == [] and cache._size() == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or prune the Whisper transcript cache")
+    parser.add_argument("command", choices=["inspect", "prune", "clear"])
+    parser.add_argument("--cache_dir", type=str, default=None, help=f"Default: {default_cache_dir()}")
+    parser.add_argument("--max_size_mb", type=float, default=1024, help="Size to prune to. Default: 1024")
+    parser.add_argument("--older_than_days", type=float, default=None, help="Also prune entries unused this long")
+    parser.add_argument("--list", action="store_true", help="inspect: list every entry")
+    args = parser.parse_args()
+
+    cache = TranscriptCache(args.cache_dir, max_bytes=int(args.max_size_mb * 1024**2))
+    if args.command == "inspect":
+        entries = cache.entries()
+        total = sum(size for _, size, _ in entries)
+        print(f"{cache.cache_dir}: {len(entries)} transcripts, {_format_size(total)}")
+        if args.list:
+            print(f"{'key':<18}{'model':<16}{'lang':<6}{'words':>8}{'size':>10}  last used")
+            for key, size, last_used in entries:
+                meta = cache.meta(key)
+                used = time.strftime("%Y-%m-%d %H:%M", time.localtime(last_used))
+                print(
+                    f"{key[:16]:<18}{str(meta.get('model'))[:15]:<16}{str(meta.get('language')):<6}"
+                    f"{meta.get('n_words', 0):>8}{_format_size(size):>10}  {used}"
+                )
+    else:
+        if args.command == "clear":
+            removed = cache.clear()
+        else:
+            older_than = args.older_than_days * 86400 if args.older_than_days is not None else None
+            removed = cache.prune(older_than=older_than)
+        print(f"Removed {len(removed)} transcripts, {_format_size(sum(s for _, s, _ in cache.entries()))} left")
@@ -0,0 +1,137 @@
+import numpy as np
+
+from utils.clip_quality import frame_clips
+from utils.transcript_cache import Word
+
+
+class Timeline:
+    """Where the speech regions kept by the VAD were in the original audio.
+
+    `regions` are `[start, end)` sample ranges of the original audio, the trimmed audio is their
+    concatenation, so a time in the trimmed audio maps back by finding its region.
+    """
+
+    def __init__(self, regions, sample_rate, total_samples):
+        self.regions = regions
+        self.sample_rate = sample_rate
+        self.total_samples = total_samples
+        lengths = regions[:, 1] - regions[:, 0]
+        self._trimmed_starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+
+    @property
+    def total_seconds(self):
+        return self.total_samples / self.sample_rate
+
+    @property
+    def speech_seconds(self):
+        return int((self.regions[:, 1] - self.regions[:, 0]).sum()) / self.sample_rate
+
+    def to_original(self, times, side="right"):
+        """Map trimmed audio times in seconds to the original audio. A time on the boundary of two regions
+        goes to the start of the later one with side="right", the end of the earlier one with side="left"."""
+        samples = np.asarray(times, dtype=np.float64) * self.sample_rate
+        idx = np.searchsorted(self._trimmed_starts, samples, side=side) - 1
+        idx = np.clip(idx, 0, len(self.regions) - 1)
+        return (self.regions[idx, 0] + samples - self._trimmed_starts[idx]) / self.sample_rate
+
+    def map_words(self, words):
+        for word in words:
+            start = float(self.to_original(word.start, side="right"))
+            end = float(self.to_original(word.end, side="left"))
+            yield Word(start, max(end, start), word.word, word.probability)
+
+
+class EnergyVAD:
+    """Frame energy voice activity detection, to keep long silences away from the ASR.
+
+    A frame of `frame_ms` is speech when its energy is within `threshold_db` of the loudest frame of the
+    file and above `floor_db` dBFS. Pauses shorter than `min_silence` seconds are kept, and `pad` seconds of
+    context are kept around speech so word edges and the clip buffers are not cut. Energy does not tell
+    speech from music, only silence and quiet noise are removed.
+    """
+
+    def __init__(self, frame_ms=30, threshold_db=-40, floor_db=-60, min_silence=0.5, pad=0.2):
+        self.frame_ms = frame_ms
+        self.threshold_db = threshold_db
+        self.floor_db = floor_db
+        self.min_silence = min_silence
+        self.pad = pad
+
+    def settings(self):
+        return {
+            "frame_ms": self.frame_ms,
+            "threshold_db": self.threshold_db,
+            "floor_db": self.floor_db,
+            "min_silence": self.min_silence,
+            "pad": self.pad,
+        }
+
+    def frame_energy(self, audio, sample_rate):
+        """Energy in dBFS of each frame, the last partial frame is zero padded"""
+        frame = max(int(sample_rate * self.frame_ms / 1000), 1)
+        frames, _, _ = frame_clips([audio], frame)
+        power = np.square(frames, dtype=np.float32).mean(axis=1)
+        return 10 * np.log10(power + 1e-10), frame
+
+    def speech_regions(self, audio, sample_rate):
+        """`[start, end)` sample ranges of speech, shape (n, 2)"""
+        if len(audio) == 0:
+            return np.zeros((0, 2), dtype=np.int64)
+        energy, frame = self.frame_energy(audio, sample_rate)
+        speech = (energy > energy.max() + self.threshold_db) & (energy > self.floor_db)
+
+        # close pauses shorter than min_silence, then widen every region by pad
+        speech = ~_drop_short_runs(~speech, int(self.min_silence * sample_rate / frame), keep_edges=True)
+        pad_frames = int(np.ceil(self.pad * sample_rate / frame))
+        if pad_frames:
+            speech = np.convolve(speech, np.ones(2 * pad_frames + 1), mode="same") > 0
+
+        edges = np.flatnonzero(np.diff(np.concatenate(([False], speech, [False])).astype(np.int8)))
+        regions = edges.reshape(-1, 2) * frame
+        regions[:, 1] = np.minimum(regions[:, 1], len(audio))
+        return regions.astype(np.int64)
+
+    def trim(self, audio, sample_rate):
+        """The speech of `audio` concatenated, and the Timeline to map times back"""
+        regions = self.speech_regions(audio, sample_rate)
+        timeline = Timeline(regions, sample_rate, len(audio))
+        if len(regions) == 1 and regions[0, 0] == 0 and regions[0, 1] == len(audio):
+            return audio, timeline
+        return np.concatenate([audio[start:end] for start, end in regions] or [audio[:0]]), timeline
+
+
+def _drop_short_runs(mask, min_length, keep_edges=False):
+    # clear the runs of True shorter than min_length, runs touching the ends are kept with keep_edges
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).astype(np.int8))).reshape(-1, 2)
+    short = edges[:, 1] - edges[:, 0] < min_length
+    if keep_edges:
+        short &= (edges[:, 0] > 0) & (edges[:, 1] < len(mask))
+    delta = np.zeros(len(mask) + 1, dtype=np.int64)
+    np.add.at(delta, edges[short, 0], 1)
+    np.add.at(delta, edges[short, 1], -1)
+    return mask & (np.cumsum(delta[:-1]) == 0)
+
+
+def test_timeline():
+    # 100 Hz, speech kept from samples 100-200 and 500-800 of 1000
+    timeline = Timeline(np.array([[100, 200], [500, 800]]), 100, 1000)
+    assert (timeline.total_seconds, timeline.speech_seconds) == (10.0, 4.0)
+    assert np.allclose(timeline.to_original([0.0, 0.5, 2.5, 4.0]), [1.0, 1.5, 6.5, 8.0])
+    # a time on the boundary of two regions is the end of the first or the start of the second
+    assert np.isclose(timeline.to_original(1.0, side="left"), 2.0)
+    assert np.isclose(timeline.to_original(1.0, side="right"), 5.0)
+    words = list(timeline.map_words([Word(0.5, 1.0, " a", 0.9), Word(1.0, 2.5, " b", 0.9)]))
+    assert [(word.start, word.end, word.word) for word in words] == [(1.5, 2.0, " a"), (5.0, 6.5, " b")], words
+
+
+def test_energy_vad_trim():
+    sample_rate = 16000
+    t = np.arange(sample_rate) / sample_rate
+    tone = (0.3 * np.sin(2 * np.pi * 200 * t)).astype(np.float32)
+    audio = np.concatenate([tone, np.zeros(2 * sample_rate, dtype=np.float32), tone])
+    speech, timeline = EnergyVAD(pad=0.1).trim(audio, sample_rate)
+    # the two seconds of silence go, except the padding kept next to the speech
+    assert len(timeline.regions) == 2 and len(speech) == int((timeline.regions[:, 1] - timeline.regions[:, 0]).sum())
+    assert 2.1 <= timeline.speech_seconds <= 2.3, timeline.speech_seconds
+    # the start of the second tone in the trimmed audio maps back to where it was
+    assert abs(float(timeline.to_original(len(speech) / sample_rate - 1.0)) - 3.0) < 0.05
@@ -14,11 +14,9 @@ import numpy as np
 import torch
 import torchaudio
 import traceback
-from utils.formatter import format_audio_list,find_latest_best_model, list_audios
+from utils.formatter import XTTS_SAMPLE_RATE, format_audio_list,find_latest_best_model, list_audios
 from utils.gpt_train import train_gpt
 
-from faster_whisper import WhisperModel
-
 from TTS.tts.configs.xtts_config import XttsConfig
 from TTS.tts.models.xtts import Xtts
 
@@ -283,7 +281,7 @@ if __name__ == "__main__":
 
             prompt_compute_btn = gr.Button(value="Step 1 - Create dataset")
         
-            def preprocess_dataset(audio_path, audio_folder_path, language, whisper_model, out_path, train_csv, eval_csv, progress=gr.Progress(track_tqdm=True)):
+            def preprocess_dataset(audio_path, audio_folder_path, language, whisper_model, out_path, train_csv, eval_csv, max_audio_length, progress=gr.Progress(track_tqdm=True)):
                 clear_gpu_cache()
             
                 train_csv = ""
@@ -301,17 +299,10 @@ if __name__ == "__main__":
                     return "No audio files found! Please provide files via Gradio or specify a folder path.", "", ""
                 else:
                     try:
-                        # Loading Whisper
-                        device = "cuda" if torch.cuda.is_available() else "cpu" 
-                        
-                        # Detect compute type 
-                        if torch.cuda.is_available():
-                            compute_type = "float16"
-                        else:
-                            compute_type = "float32"
-                        
-                        asr_model = WhisperModel(whisper_model, device=device, compute_type=compute_type)
-                        train_meta, eval_meta, audio_total_size = format_audio_list(audio_files, asr_model=asr_model, target_language=language, out_path=out_path, gradio_progress=progress)
+                        # the Whisper model comes from the ASR pool and stays loaded for the next run
+                        # clips longer than the training max audio length would be skipped by the trainer, and clips
+                        # are written at the training sample rate so the trainer does not resample them every epoch
+                        train_meta, eval_meta, audio_total_size = format_audio_list(audio_files, whisper_model=whisper_model, target_language=language, out_path=out_path, gradio_progress=progress, max_duration=max_audio_length, sample_rate=XTTS_SAMPLE_RATE, pcm16=True, audio_root=audio_folder_path or None)
                     except:
                         traceback.print_exc()
                         error = traceback.format_exc()
@@ -659,7 +650,8 @@ if __name__ == "__main__":
                     whisper_model,
                     out_path,
                     train_csv,
-                    eval_csv
+                    eval_csv,
+                    max_audio_length,
                 ],
                 outputs=[
                     progress_data,